@@ -47,7 +47,7 @@ const App: React.FC = () => {
   const [stats, setStats] = useState<ServerStats | null>(null);
   const [isConnected, setIsConnected] = useState(false);
 
-  // Fetch stats periodically
+  // Live stats over Server-Sent Events; fall back to polling if the stream is unavailable
   useEffect(() => {
     const fetchStats = async () => {
       try {
@@ -62,9 +62,29 @@ const App: React.FC = () => {
       }
     };
 
-    fetchStats();
-    const interval = setInterval(fetchStats, 10000);
-    return () => clearInterval(interval);
+    if (typeof EventSource === 'undefined') {
+      fetchStats();
+      const interval = setInterval(fetchStats, 10000);
+      return () => clearInterval(interval);
+    }
+
+    const source = new EventSource('/stream/stats');
+    source.addEventListener('snapshot', (e) => {
+      setStats(JSON.parse((e as MessageEvent).data));
+      setIsConnected(true);
+    });
+    source.addEventListener('delta', (e) => {
+      const delta = JSON.parse((e as MessageEvent).data);
+      setStats((prev) => {
+        if (!prev) return prev;
+        const next: any = { ...prev, ...delta.set };
+        for (const key of delta.del || []) delete next[key];
+        return next;
+      });
+      setIsConnected(true);
+    });
+    source.onerror = () => setIsConnected(false); // EventSource reconnects on its own
+    return () => source.close();
   }, []);
 
   // Fetch configuration whenever entering the config tab
@@ -1,17 +1,31 @@
 
 #!/usr/bin/python3
-import psutil, json, os, logging, signal, shutil, datetime, smtplib, time, threading, sys, uuid, subprocess
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse, parse_qs
+import psutil, io, json, os, logging, signal, shutil, datetime, smtplib, time, threading, sys, uuid, subprocess, gzip, hashlib, mmap, struct, heapq, pwd, fnmatch, stat, re, collections, queue, socket, atexit, tempfile, tracemalloc
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote, unquote
 import urllib.request
 import mimetypes # Import mimetypes for serving static files
+try: import zstandard # Optional: preferred heartbeat compression when both ends have it
+except ImportError: zstandard = None
 
 CONFIG_PATH = '/etc/ang-monitor/config.json'
 REVERT_PATH = '/etc/ang-monitor/revert_state.json'
 LOG_PATH = '/opt/ang-monitor/audit.log'
 AGENT_ID_PATH = '/etc/ang-monitor/agent_id'
+TSDB_PATH = '/opt/ang-monitor/tsdb'
+KMSG_STATE_PATH = '/opt/ang-monitor/kmsg_state.json'
+ALERT_STATE_PATH = '/opt/ang-monitor/alert_state.json'
+HUB_STATE_PATH = '/opt/ang-monitor/hub_state'
 
 HUB_AGENTS = {}
+HUB_LOCK = threading.RLock() # Guards HUB_AGENTS; the hub serves requests concurrently
+HUB_WAITERS = {} # agentId -> Condition(HUB_LOCK), signalled when a task is queued for that agent
+
+HUB_URL = "http://127.0.0.1:9090" # Localhost loopback
+HEARTBEAT_INTERVAL = 10 # Stats push cadence (seconds); tasks arrive over the long-poll channel
+TASK_POLL_WAIT = 25 # Seconds the hub holds an idle /hub/poll request open
+TASK_ACK_TIMEOUT = 120 # Delivered tasks not acknowledged via /hub/result within this are redelivered
 
 def get_agent_id():
     if os.path.exists(AGENT_ID_PATH):
@@ -27,16 +41,166 @@ def get_agent_id():
 
 AGENT_ID = get_agent_id()
 
-def log_audit(event):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
-        with open(LOG_PATH, 'a') as f:
-            f.write(f"[{timestamp}] {event}\n")
-    except: pass
+# --- Audit log ---
+# JSON-lines records buffered in memory and appended by a background thread. The live file
+# rotates on size or age into gzip segments named <LOG_PATH>.<first epoch>-<last epoch>.gz,
+# each with a sidecar .idx holding (epoch, uncompressed offset) checkpoints every
+# AUDIT_INDEX_EVERY lines, so time-range queries can skip whole segments or seek into them.
+AUDIT_FLUSH_SECONDS = 2
+AUDIT_MAX_BYTES = 10 * 1024 * 1024
+AUDIT_ROTATE_SECONDS = 86400
+AUDIT_KEEP_SEGMENTS = 60
+AUDIT_INDEX_EVERY = 1000
+AUDIT_BUFFER_MAX = 10000 # Past this, new records are dropped until the next flush
 
-def load_config():
-    defaults = {
+def parse_audit_line(line):
+    line = line.strip()
+    if not line: return None
+    if line.startswith('{'):
+        try: return json.loads(line)
+        except ValueError: return None
+    if line.startswith('[') and '] ' in line: # Plain-text record from older versions
+        ts, msg = line[1:].split('] ', 1)
+        try: epoch = datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError: epoch = 0
+        return {'ts': ts, 'epoch': epoch, 'type': msg.split(':', 1)[0].strip(), 'msg': msg}
+    return None
+
+class AuditLog:
+    def __init__(self, path=LOG_PATH):
+        self.path = path; self.lock = threading.Lock(); self.flush_lock = threading.Lock()
+        self.buffer = []; self.last = None; self.dropped = 0; self.thread = None; self.checked = 0
+
+    def write(self, event, kind=None, **fields):
+        now = time.time()
+        rec = {'ts': datetime.datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"), 'epoch': round(now, 3),
+               'type': kind or str(event).split(':', 1)[0].strip()[:64], 'msg': str(event), 'proc': os.getpid(), **fields}
+        with self.lock:
+            if self.last is not None and self.last['msg'] == rec['msg']: # last is always the newest buffered record
+                self.last['repeat'] = self.last.get('repeat', 1) + 1; self.last['lastEpoch'] = rec['epoch'] # Collapse error storms
+            elif len(self.buffer) >= AUDIT_BUFFER_MAX: self.dropped += 1
+            else: self.buffer.append(rec); self.last = rec
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, daemon=True); self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(AUDIT_FLUSH_SECONDS)
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                records, self.buffer, self.last = self.buffer, [], None
+                dropped, self.dropped = self.dropped, 0
+            if dropped: records.append({'ts': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'epoch': round(time.time(), 3), 'type': 'audit', 'msg': f"Audit buffer full: {dropped} records dropped"})
+            try:
+                if records:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    with open(self.path, 'a') as f: f.write(''.join(json.dumps(r, default=str) + '\n' for r in records))
+                if records or time.time() - self.checked > 60: self._maybe_rotate()
+            except OSError: pass
+
+    def _maybe_rotate(self):
+        self.checked = time.time()
+        try: size = os.path.getsize(self.path)
+        except OSError: return
+        with open(self.path, errors='replace') as f: first = parse_audit_line(f.readline()) or {}
+        start = int(first.get('epoch') or time.time())
+        if size < AUDIT_MAX_BYTES and time.time() - start < AUDIT_ROTATE_SECONDS: return
+        rotating = f"{self.path}.rotating"
+        os.replace(self.path, rotating)
+        index = []; end = start; offset = 0
+        with open(rotating, 'rb') as src, gzip.open(rotating + '.gz', 'wb') as dst:
+            for n, line in enumerate(src):
+                rec = parse_audit_line(line.decode(errors='replace'))
+                if rec and rec.get('epoch'): end = int(rec['epoch'])
+                if n % AUDIT_INDEX_EVERY == 0 and rec: index.append([rec.get('epoch', 0), offset])
+                dst.write(line); offset += len(line)
+        name = f"{self.path}.{start}-{end}"; k = 1
+        while os.path.exists(name + '.gz'): name = f"{self.path}.{start}-{end}-{k}"; k += 1 # Several rotations in one second
+        with open(name + '.idx', 'w') as f: json.dump(index, f)
+        os.replace(rotating + '.gz', name + '.gz'); os.remove(rotating)
+        for old in self.segments()[:-1][:-AUDIT_KEEP_SEGMENTS]:
+            for p in (old[0], old[0][:-3] + '.idx'):
+                try: os.remove(p)
+                except OSError: pass
+
+    def segments(self):
+        """[(path, first epoch, last epoch)] oldest first; the live file comes last with open end."""
+        d, base = os.path.split(self.path); found = []
+        try: names = os.listdir(d or '.')
+        except OSError: names = []
+        for n in names:
+            if n.startswith(base + '.') and n.endswith('.gz'):
+                try: a, b = n[len(base) + 1:-3].split('-')[:2]; found.append((os.path.join(d, n), int(a), int(b)))
+                except ValueError: pass
+        found.sort(key=lambda x: (x[1], x[2], len(x[0]), x[0])) # Same-second rotations carry a -N suffix
+        if os.path.exists(self.path): found.append((self.path, found[-1][2] if found else 0, float('inf')))
+        return found
+
+    def _read(self, path, start_offset=0, end_offset=None):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            f.seek(start_offset); offset = start_offset
+            for line in f:
+                if end_offset is not None and offset >= end_offset: break
+                yield offset, line; offset += len(line)
+
+    def query(self, kind=None, since=None, until=None, pid=None, path=None, text=None, limit=200, cursor=None):
+        """Newest-first matching records. cursor '<segment>:<offset>' continues an earlier page."""
+        self.flush()
+        cur_seg, cur_off = (cursor.rsplit(':', 1) + [None])[:2] if cursor else (None, None)
+        results = []; next_cursor = None; reached = cur_seg is None
+        for seg, first, last in reversed(self.segments()):
+            name = os.path.basename(seg)
+            if not reached:
+                if name != cur_seg: continue
+                reached = True
+            if (since and last < since) or (until and first > until): continue
+            start = 0
+            if since and seg.endswith('.gz'):
+                try:
+                    with open(seg[:-3] + '.idx') as f: start = max([o for e, o in json.load(f) if e <= since] or [0])
+                except (OSError, ValueError): pass
+            end = int(cur_off) if name == cur_seg and cur_off else None
+            want = limit - len(results); page = collections.deque(maxlen=want)
+            for offset, line in self._read(seg, start, end):
+                rec = parse_audit_line(line.decode(errors='replace'))
+                if not rec: continue
+                e = rec.get('epoch', 0)
+                if (since and e < since) or (until and e > until): continue
+                if kind and rec.get('type') != kind: continue
+                if pid is not None and str(rec.get('pid')) != str(pid): continue
+                if path and path not in str(rec.get('path', rec.get('msg', ''))): continue
+                if text and text.lower() not in rec.get('msg', '').lower(): continue
+                page.append((offset, rec))
+            results.extend(dict(r, cursor=f"{name}:{o}") for o, r in reversed(page))
+            if len(results) >= limit:
+                next_cursor = results[-1]['cursor']; break
+        return {'entries': results, 'cursor': next_cursor}
+
+    def tail_from(self, offset=0, limit=1000):
+        """Records appended to the live file after byte offset; returns the offset to resume from."""
+        self.flush(); out = []; pos = offset
+        try:
+            if os.path.getsize(self.path) < offset: pos = offset = 0 # Rotated since the caller's last read
+            for o, line in self._read(self.path, offset):
+                if len(out) >= limit: break
+                rec = parse_audit_line(line.decode(errors='replace'))
+                if rec: out.append(rec)
+                pos = o + len(line)
+        except OSError: pass
+        return {'entries': out, 'offset': pos}
+
+AUDIT_LOG = AuditLog()
+atexit.register(AUDIT_LOG.flush)
+
+def log_audit(event, kind=None, **fields):
+    AUDIT_LOG.write(event, kind, **fields)
+
+def config_defaults():
+    return {
         "customerName": f"SLES-{AGENT_ID}",
         "memoryThresholdGB": 2.0,
         "partitions": [{"path": "/", "enabled": True, "threshold": 90}],
@@ -48,32 +212,106 @@ def load_config():
             "ram": 5,
             "disk": 10,
             "process": 5
+        },
+        "history": { # Hub time-series retention per resolution tier
+            "rawDays": 2,
+            "minuteDays": 30,
+            "hourDays": 400
         }
     }
-    if os.path.exists(CONFIG_PATH):
-        try:
-            with open(CONFIG_PATH, 'r') as f:
-                cfg = json.load(f)
-                # Ensure all default keys exist, even if new in later versions
-                for key, default_val in defaults.items():
-                    if key not in cfg:
-                        cfg[key] = default_val
-                    elif isinstance(default_val, dict) and isinstance(cfg[key], dict):
-                        for sub_key, sub_default_val in default_val.items():
-                            if sub_key not in cfg[key] or cfg[key][sub_key] is None:
-                                cfg[key][sub_key] = sub_default_val
-                return cfg
-        except Exception as e:
-            log_audit(f"Error loading config: {e}")
-            pass # Fallback to defaults if file is corrupt
-    return defaults
+
+def validate_config(cfg):
+    """Raise ValueError if cfg is not a usable config."""
+    if not isinstance(cfg, dict): raise ValueError("config must be an object")
+    float(cfg.get('memoryThresholdGB', 0))
+    if not isinstance(cfg.get('partitions', []), list) or not all(isinstance(p, dict) and p.get('path') for p in cfg.get('partitions', [])):
+        raise ValueError("partitions must be a list of objects with a path")
+    for key in ('email', 'intervals', 'history'):
+        if not isinstance(cfg.get(key, {}), dict): raise ValueError(f"{key} must be an object")
+    for key, val in cfg.get('intervals', {}).items(): float(val)
+
+class ConfigManager:
+    """Parsed config snapshot, reloaded only when the file's mtime changes.
+
+    The snapshot returned by get() is shared: treat it as read-only. Writes go through a temp
+    file plus rename, so readers in other processes never see a half-written file.
+    """
+    RECHECK_SECONDS = 1
+
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path; self.lock = threading.RLock(); self.subscribers = []
+        self.snapshot = None; self.stamp = None; self.checked = 0
+
+    def subscribe(self, fn):
+        """fn(new, old) is called after every config change."""
+        self.subscribers.append(fn)
+
+    def _notify(self, new, old):
+        for fn in list(self.subscribers):
+            try: fn(new, old)
+            except Exception as e: log_audit(f"Config subscriber error: {e}")
+
+    def _merge_defaults(self, cfg):
+        # Ensure all default keys exist, even if new in later versions
+        for key, default_val in config_defaults().items():
+            if key not in cfg or cfg[key] is None:
+                cfg[key] = default_val
+            elif isinstance(default_val, dict) and isinstance(cfg[key], dict):
+                for sub_key, sub_default_val in default_val.items():
+                    if sub_key not in cfg[key] or cfg[key][sub_key] is None:
+                        cfg[key][sub_key] = sub_default_val
+        return cfg
+
+    def get(self):
+        now = time.time()
+        if self.snapshot is not None and now - self.checked < self.RECHECK_SECONDS: return self.snapshot
+        with self.lock:
+            self.checked = now
+            try: st = os.stat(self.path); stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except OSError: stamp = None
+            if self.snapshot is not None and stamp == self.stamp: return self.snapshot
+            old = self.snapshot; self.stamp = stamp
+            if stamp is None: new = config_defaults()
+            else:
+                try:
+                    with open(self.path, 'r') as f: new = json.load(f)
+                    self._merge_defaults(new); validate_config(new) # Nulls take defaults before validation
+                except Exception as e:
+                    log_audit(f"Error loading config: {e}")
+                    new = old if old is not None else config_defaults() # Keep the last good snapshot
+            if new is not old:
+                self.snapshot = new
+                if old is not None: self._notify(new, old)
+            return self.snapshot
+
+    def save(self, data):
+        with self.lock:
+            data = json.loads(json.dumps(data)) # Own copy: callers keep theirs, the snapshot stays unshared
+            if not isinstance(data, dict): raise ValueError("config must be an object")
+            self._merge_defaults(data) # Dashboard sends null for an empty field; nulls take defaults
+            if isinstance(data['email'], dict) and data['email'].get('port') == "": data['email']['port'] = 587
+            validate_config(data)
+            old = self.get()
+            data['configVersion'] = int(old.get('configVersion', 0) or 0) + 1
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=4); f.flush(); os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            st = os.stat(self.path)
+            self.stamp = (st.st_mtime_ns, st.st_size, st.st_ino); self.checked = time.time()
+            self.snapshot = self._merge_defaults(data)
+            self._notify(self.snapshot, old)
+            return self.snapshot
+
+CONFIG = ConfigManager()
+
+def load_config():
+    return CONFIG.get()
 
 def save_config(data):
     try:
-        os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
-        if 'email' in data and (data['email'].get('port') is None or data['email'].get('port') == ""):
-            data['email']['port'] = 587
-        with open(CONFIG_PATH, 'w') as f: json.dump(data, f, indent=4)
+        CONFIG.save(data)
         return True
     except Exception as e:
         log_audit(f"Error saving config: {e}")
@@ -124,149 +362,1338 @@ def get_detailed_server_info():
 
     return info
 
+# --- Kernel tunables ---
+# Reads and writes /proc/sys and /sys/kernel/mm directly (no sysctl forks) in one batched pass.
+# TUNABLE_ROOT is pluggable so a fake procfs tree can stand in. The built-in catalog can be
+# extended or overridden by TUNING_CATALOG_PATH ({"version": n, "params": [...]}).
+TUNABLE_ROOT = '/'
+TUNING_CATALOG_PATH = '/etc/ang-monitor/tuning_catalog.json'
+TUNING_CATALOG_VERSION = 1
+TUNING_CATALOG = [ # recommended may be a callable of total memory in bytes
+    {"param": "vm.max_map_count", "recommended": "2147483647"},
+    {"param": "kernel.pid_max", "recommended": "4194304"},
+    {"param": "kernel.numa_balancing", "recommended": "0"},
+    {"param": "kernel.shmmax", "recommended": lambda total: str(total)},
+    {"param": "kernel.shmall", "recommended": lambda total: str(total // PAGE_SIZE)},
+    {"param": "fs.aio-max-nr", "recommended": "1048576"},
+    {"param": "net.core.somaxconn", "recommended": "4096"},
+    {"param": "thp_enabled", "path": "sys/kernel/mm/transparent_hugepage/enabled", "recommended": "never"},
+    {"param": "ksm_run", "path": "sys/kernel/mm/ksm/run", "recommended": "0"},
+]
+MEM_TOTAL = None # Physical memory does not change while we run
+
+def tunable_path(entry, root=None):
+    rel = entry.get('path') or 'proc/sys/' + entry['param'].replace('.', '/')
+    return os.path.join(root or TUNABLE_ROOT, rel)
+
+def tuning_catalog():
+    """Built-in catalog merged with the optional on-disk override; returns (version, entries)."""
+    entries = {e['param']: e for e in TUNING_CATALOG}; version = TUNING_CATALOG_VERSION
+    try:
+        with open(TUNING_CATALOG_PATH) as f: extra = json.load(f)
+        for e in extra.get('params', []):
+            if e.get('param'): entries[e['param']] = dict(entries.get(e['param'], {}), **e)
+        version = f"{TUNING_CATALOG_VERSION}+{extra.get('version', 0)}"
+    except (OSError, ValueError): pass
+    return version, list(entries.values())
+
 def get_tuning_params():
-    mem = psutil.virtual_memory()
-    page_size = os.sysconf('SC_PAGE_SIZE')
-    return {
-        "vm.max_map_count": "2147483647",
-        "kernel.pid_max": "4194304",
-        "kernel.numa_balancing": "0",
-        "kernel.shmmax": str(mem.total),
-        "kernel.shmall": str(mem.total // page_size),
-        "fs.aio-max-nr": "1048576",
-        "net.core.somaxconn": "4096",
-        "thp_enabled": "never",
-        "ksm_run": "0"
-    }
+    global MEM_TOTAL
+    if MEM_TOTAL is None: MEM_TOTAL = psutil.virtual_memory().total
+    return {e['param']: e['recommended'](MEM_TOTAL) if callable(e['recommended']) else str(e['recommended']) for e in tuning_catalog()[1]}
 
-def scan_tune():
-    recommended = get_tuning_params()
-    results = []
-    for param, rec in recommended.items():
-        current = "N/A"
+def read_tunables(entries, root=None):
+    values = {}
+    for e in entries:
         try:
-            if param == "thp_enabled":
-                if os.path.exists('/sys/kernel/mm/transparent_hugepage/enabled'):
-                    content = open('/sys/kernel/mm/transparent_hugepage/enabled').read()
-                    current = content.split('[')[1].split(']')[0] if '[' in content else content.strip()
-            elif param == "ksm_run":
-                if os.path.exists('/sys/kernel/mm/ksm/run'):
-                    current = open('/sys/kernel/mm/ksm/run').read().strip()
-            else:
-                current = subprocess.check_output(['sysctl', '-n', param]).decode().strip()
-        except: pass
-        results.append({"param": param, "current": current, "recommended": rec, "status": "OK" if str(current) == str(rec) else "MISMATCH"})
+            with open(tunable_path(e, root)) as f: raw = f.read()
+            # sysfs selectors such as "always madvise [never]" report the bracketed choice
+            values[e['param']] = raw.split('[')[1].split(']')[0] if '[' in raw else ' '.join(raw.split())
+        except OSError: values[e['param']] = None
+    return values
+
+def write_tunables(values, entries, root=None):
+    """Write all values or none: on the first failure, already-written params are restored."""
+    by_param = {e['param']: e for e in entries}
+    before = read_tunables([by_param[p] for p in values], root); written = []
+    try:
+        for param, val in values.items():
+            with open(tunable_path(by_param[param], root), 'w') as f: f.write(str(val))
+            written.append(param)
+    except OSError as e:
+        for param in written:
+            try:
+                with open(tunable_path(by_param[param], root), 'w') as f: f.write(str(before[param]))
+            except OSError: pass
+        raise OSError(f"{param}: {e}")
+    return before
+
+def scan_tune(root=None):
+    _, entries = tuning_catalog(); recommended = get_tuning_params()
+    current = read_tunables(entries, root); results = []
+    for e in entries:
+        cur = current[e['param']]; rec = recommended[e['param']]
+        results.append({"param": e['param'], "current": cur if cur is not None else "N/A", "recommended": rec, "status": "OK" if cur == str(rec) else "MISMATCH"})
     return results
 
-def handle_task(task):
+def _write_revert_state(text):
+    tmp = REVERT_PATH + '.tmp'
+    with open(tmp, 'w') as f: f.write(text); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, REVERT_PATH)
+
+def apply_tune(root=None):
+    """Snapshot the originals first, then write; a failed snapshot applies nothing."""
+    version, entries = tuning_catalog(); recommended = get_tuning_params()
+    current = read_tunables(entries, root)
+    changes = {p: v for p, v in recommended.items() if current.get(p) is not None and current[p] != v}
+    if not changes: return changes
+    before = {p: current[p] for p in changes}; prior_text = None
+    try: # Keep the originals from an earlier apply so a second apply cannot overwrite them
+        with open(REVERT_PATH) as f: prior_text = f.read()
+        prior = json.loads(prior_text)
+        before.update(prior.get('values', {}) if 'version' in prior else prior)
+    except (OSError, ValueError): pass
+    _write_revert_state(json.dumps({'version': version, 'values': before}))
+    try: write_tunables(changes, entries, root)
+    except OSError: # Nothing stayed applied: put the snapshot back the way it was
+        if prior_text is None: os.remove(REVERT_PATH)
+        else: _write_revert_state(prior_text)
+        raise
+    return changes
+
+def revert_tune(root=None):
+    with open(REVERT_PATH, 'r') as f: state = json.load(f)
+    values = state.get('values', state) if 'version' in state else state # Older files were a flat dict
+    _, entries = tuning_catalog()
+    known = {e['param'] for e in entries}
+    entries += [{'param': p} for p in values if p not in known]
+    write_tunables({p: v for p, v in values.items() if v is not None}, entries, root)
+    os.remove(REVERT_PATH) # Consumed: a later apply must snapshot the values in place at that time
+
+# --- Directory listing and background du ---
+LS_PAGE_SIZE = 500
+LS_CACHE = collections.OrderedDict() # (path, dir mtime, filters, sort) -> sorted listing, so later pages skip the rescan
+LS_CACHE_LOCK = threading.Lock() # ls runs concurrently on the task executor
+LS_CACHE_MAX_ENTRIES = 200000 # Total cached rows across listings; a larger single listing is rescanned per page
+DU_CACHE = collections.OrderedDict() # directory -> (mtime, checked at, bytes of its direct files, subdirectories), LRU
+DU_CACHE_MAX = 100000 # Directories; each is a subdirectory of one other entry, so this also bounds the stored paths
+DU_CACHE_TTL = 300 # Bounds staleness from files growing in place, which does not touch the dir mtime
+DU_JOBS = {}
+DU_JOBS_MAX = 16
+DU_MAX_RUNNING = 2 # Concurrent walks; a repeat du of a path already being walked joins that job
+DU_LOCK = threading.Lock()
+
+def _fmt_size(s):
+    return f"{round(s/1024/1024,2)} MB" if s > 1024 else "-"
+
+def _scan_entries(p, glob_pat, min_size, max_size, mtime_after, mtime_before):
+    items = []
+    with os.scandir(p) as it:
+        for e in it:
+            if glob_pat and not fnmatch.fnmatch(e.name, glob_pat): continue
+            try:
+                is_dir = e.is_dir(follow_symlinks=False); st = e.stat(follow_symlinks=False)
+            except OSError: is_dir, st = False, None
+            size = st.st_size if st and not is_dir else 0; mtime = st.st_mtime if st else 0
+            if (min_size and size < min_size) or (max_size and size > max_size): continue
+            if (mtime_after and mtime < mtime_after) or (mtime_before and mtime > mtime_before): continue
+            items.append((e.name, is_dir, size, mtime)) # Compact rows; dicts are built for the served page only
+    return items
+
+def list_dir(args):
+    """Paged, filtered scandir listing. Pass the returned cursor back as args.cursor for the next page."""
+    p = args.get('path', '/')
+    if not os.path.isdir(p): return {"type": "ls", "path": p, "data": [], "total": 0, "cursor": None}
+    sort_by = args.get('sort', 'name'); desc = bool(args.get('desc', False))
+    filters = tuple(args.get(k) for k in ('glob', 'min_size', 'max_size', 'mtime_after', 'mtime_before'))
+    key = (p, os.stat(p).st_mtime, filters, sort_by, desc)
+    with LS_CACHE_LOCK: items = LS_CACHE.pop(key, None)
+    if items is None:
+        items = _scan_entries(p, *filters)
+        if sort_by in ('size', 'mtime'): items.sort(key=lambda x: x[2 if sort_by == 'size' else 3], reverse=desc)
+        else: items.sort(key=lambda x: (not x[1], x[0]), reverse=desc)
+    if len(items) <= LS_CACHE_MAX_ENTRIES:
+        with LS_CACHE_LOCK:
+            LS_CACHE.pop(key, None) # A concurrent scan of the same listing may have stored it meanwhile
+            while LS_CACHE and sum(map(len, LS_CACHE.values())) + len(items) > LS_CACHE_MAX_ENTRIES: LS_CACHE.popitem(last=False)
+            LS_CACHE[key] = items
+    try: offset = max(int(args.get('cursor') or 0), 0); limit = min(max(int(args.get('limit') or LS_PAGE_SIZE), 1), 5000)
+    except (TypeError, ValueError): offset, limit = 0, LS_PAGE_SIZE
+    nxt = offset + limit if offset + limit < len(items) else None
+    page = [{'name': n, 'full_path': os.path.join(p, n), 'type': 'dir' if d else 'file', 'size': _fmt_size(b), 'bytes': b, 'mtime': m}
+            for n, d, b, m in items[offset:offset + limit]]
+    return {"type": "ls", "path": p, "data": page, "offset": offset, "total": len(items), "cursor": nxt}
+
+def _du_dir(path, job):
+    """Recursive size of path on the job's filesystem (du -x); per-directory file totals are cached against the directory mtime."""
+    try: st = os.stat(path)
+    except OSError: return 0
+    if st.st_dev != job['dev']: job['mountsSkipped'] += 1; return 0
+    now = time.time()
+    with DU_LOCK:
+        cached = DU_CACHE.get(path)
+        if cached: DU_CACHE.move_to_end(path)
+    if cached and cached[0] == st.st_mtime and now - cached[1] < DU_CACHE_TTL:
+        own, subdirs = cached[2], cached[3]; job['cacheHits'] += 1
+    else:
+        own, subdirs = 0, []
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False): subdirs.append(e.path)
+                        else: own += e.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError: pass
+        except OSError: pass
+        with DU_LOCK:
+            DU_CACHE[path] = (st.st_mtime, now, own, subdirs); DU_CACHE.move_to_end(path)
+            while len(DU_CACHE) > DU_CACHE_MAX: DU_CACHE.popitem(last=False)
+    job['dirsScanned'] += 1; job['bytes'] += own
+    total = own
+    for d in subdirs:
+        if job['cancel']: break
+        total += _du_dir(d, job)
+    return total
+
+def _du_worker(job):
+    root = job['path']; children = []
+    try:
+        own = 0; job['dev'] = os.stat(root).st_dev
+        with os.scandir(root) as it: entries = list(it)
+        for e in entries:
+            if job['cancel']: break
+            try:
+                if e.is_dir(follow_symlinks=False): children.append({'path': e.path, 'bytes': _du_dir(e.path, job)})
+                else:
+                    b = e.stat(follow_symlinks=False).st_blocks * 512; own += b; job['bytes'] += b
+            except OSError: pass
+        job['top'] = heapq.nlargest(20, children, key=lambda c: c['bytes'])
+        job['status'] = 'cancelled' if job['cancel'] else 'done'
+    except Exception as e:
+        job['status'] = 'error'; job['error'] = str(e)
+    job['finished'] = time.time()
+
+def start_du(path):
+    if not os.path.isdir(path): return {"type": "du", "error": f"not a directory: {path}"}
+    path = os.path.abspath(path)
+    job = {'jobId': uuid.uuid4().hex[:12], 'path': path, 'status': 'running', 'started': time.time(), 'finished': None,
+           'dirsScanned': 0, 'bytes': 0, 'cacheHits': 0, 'mountsSkipped': 0, 'top': [], 'cancel': False}
+    with DU_LOCK:
+        running = [v for v in DU_JOBS.values() if v['status'] == 'running']
+        same = next((v for v in running if v['path'] == path and not v['cancel']), None)
+        if same: return du_status(same['jobId'])
+        if len(running) >= DU_MAX_RUNNING: return {"type": "du", "error": f"{len(running)} du jobs already running; retry later"}
+        for old in [j for j, v in DU_JOBS.items() if v['status'] != 'running'][:max(0, len(DU_JOBS) - DU_JOBS_MAX + 1)]: DU_JOBS.pop(old)
+        DU_JOBS[job['jobId']] = job
+    threading.Thread(target=_du_worker, args=(job,), daemon=True).start()
+    return du_status(job['jobId'])
+
+def cancel_du(job_id):
+    job = DU_JOBS.get(job_id)
+    if not job: return {"type": "cancel", "error": "unknown task"}
+    job['cancel'] = True
+    return {"type": "cancel", "jobId": job_id, "status": "cancelling"}
+
+def du_status(job_id):
+    job = DU_JOBS.get(job_id)
+    if not job: return {"type": "du", "error": "unknown job"}
+    return {"type": "du", **{k: v for k, v in job.items() if k not in ('cancel', 'dev')}}
+
+def remove_path(path, progress=None):
+    """rm -r with per-file progress; stops early when progress['cancel'] is set."""
+    progress = progress if progress is not None else {}
+    progress.setdefault('filesDeleted', 0); progress.setdefault('bytesFreed', 0)
+    def unlink(p):
+        size = os.lstat(p).st_blocks * 512
+        os.remove(p); progress['filesDeleted'] += 1; progress['bytesFreed'] += size
+    if not os.path.isdir(path) or os.path.islink(path): unlink(path); return progress
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            if progress.get('cancel'): return progress
+            unlink(os.path.join(root, name))
+        for name in dirs:
+            if not os.path.islink(os.path.join(root, name)): os.rmdir(os.path.join(root, name))
+    os.rmdir(path)
+    return progress
+
+def handle_task(task, progress=None):
     t_type = task.get('type'); args = task.get('args', {})
     try:
+        if t_type == 'cancel': return TASK_EXECUTOR.cancel(args.get('taskId')) if args.get('taskId') else cancel_du(args.get('jobId'))
         if t_type == 'set_config': return {"status": "ok", "type": "config"} if save_config(args) else {"error": "save failed"}
-        if t_type == 'kill': os.kill(args['pid'], signal.SIGKILL); log_audit(f"Killed Process: {args['pid']}"); return {"status": "ok"}
-        if t_type == 'ls':
-            p = args.get('path', '/'); items = []
-            if os.path.exists(p):
-                for f in os.listdir(p):
-                    full = os.path.join(p, f); is_dir = os.path.isdir(full); 
-                    try: s = os.path.getsize(full) if not is_dir else 0
-                    except: s = 0
-                    items.append({'name': f, 'full_path': full, 'type': 'dir' if is_dir else 'file', 'size': f"{round(s/1024/1024,2)} MB" if s > 1024 else "-"})
-            return {"type": "ls", "data": sorted(items, key=lambda x: (x['type']!='dir', x['name']))}
+        if t_type == 'kill': os.kill(args['pid'], signal.SIGKILL); log_audit(f"Killed Process: {args['pid']}", pid=args['pid']); return {"status": "ok"}
+        if t_type == 'ls': return list_dir(args)
+        if t_type == 'du': return start_du(args.get('path', '/'))
+        if t_type == 'du_status': return du_status(args.get('jobId'))
         if t_type == 'scan_tune': return {"type": "tune_results", "data": scan_tune()}
         if t_type == 'apply_tune':
-            recommended = get_tuning_params()
-            revert_state = {}
-            for param, val in recommended.items():
-                try:
-                    current = ""
-                    if param == "thp_enabled": pass
-                    elif param == "ksm_run": pass
-                    else:
-                        current = subprocess.check_output(['sysctl', '-n', param]).decode().strip()
-                        subprocess.call(['sysctl', '-w', f"{param}={val}"])
-                        revert_state[param] = current
-                except: pass
-            with open(REVERT_PATH, 'w') as f: json.dump(revert_state, f)
-            log_audit("Applied SAP Tunings")
-            return {"type": "tune_apply", "status": "ok"}
+            changes = apply_tune()
+            log_audit(f"Applied SAP Tunings: {', '.join(changes) or 'none needed'}")
+            return {"type": "tune_apply", "status": "ok", "changed": sorted(changes)}
         if t_type == 'revert_tune':
             if os.path.exists(REVERT_PATH):
-                with open(REVERT_PATH, 'r') as f:
-                    revert_state = json.load(f)
-                    for param, val in revert_state.items():
-                        subprocess.call(['sysctl', '-w', f"{param}={val}"])
+                revert_tune()
                 log_audit("Reverted SAP Tunings")
                 return {"type": "tune_revert", "status": "ok"}
             return {"error": "no revert state found"}
         if t_type == 'rm':
             path = args.get('path')
-            if os.path.isdir(path): shutil.rmtree(path)
-            else: os.remove(path)
-            log_audit(f"Deleted Path: {path}")
-            return {"status": "ok", "type": "rm"}
+            done = remove_path(path, progress)
+            if done.get('cancel'):
+                log_audit(f"Delete cancelled: {path}", path=path)
+                return {"status": "cancelled", "type": "rm", "filesDeleted": done['filesDeleted'], "bytesFreed": done['bytesFreed']}
+            log_audit(f"Deleted Path: {path}", path=path)
+            return {"status": "ok", "type": "rm", "filesDeleted": done['filesDeleted'], "bytesFreed": done['bytesFreed']}
     except Exception as e: return {"error": str(e)}
     return None
 
-def get_stats():
-    cfg = load_config(); mem = psutil.virtual_memory(); disk_stats = []
+# --- Agent task executor ---
+# Heavy tasks run on worker threads so neither the heartbeat nor the task poll ever waits on
+# them. Each type has its own concurrency limit and timeout. LONG_TASKS post an 'accepted'
+# (non-final) result straight away and report progress in heartbeats under taskProgress;
+# every task posts one final result. Cancellation is cooperative (checked by rm per file).
+TASK_MAX_WORKERS = 8
+TASK_LIMITS = {'rm': 2, 'ls': 4, 'scan_tune': 2, 'apply_tune': 1, 'revert_tune': 1}
+TASK_TIMEOUTS = {'rm': 6 * 3600, 'ls': 300, 'scan_tune': 120, 'apply_tune': 300, 'revert_tune': 300}
+POOLED_TASKS = set(TASK_LIMITS)
+LONG_TASKS = {'rm', 'apply_tune', 'revert_tune'}
+
+class TaskExecutor:
+    def __init__(self):
+        self.lock = threading.Lock(); self.pending = collections.deque(); self.running = {}
+        self.abandoned = {} # Timed-out entries whose thread is still alive; they keep their slot until it exits
+        self.watchdog = None
+
+    def submit(self, task, on_done):
+        """Queue task; on_done(result) is called exactly once with the final result."""
+        entry = {'task': task, 'on_done': on_done, 'progress': {}, 'status': 'queued', 'queued': time.time(), 'started': None, 'finished': False}
+        with self.lock:
+            self.pending.append(entry)
+            if not self.watchdog:
+                self.watchdog = threading.Thread(target=self._watch, daemon=True); self.watchdog.start()
+        self._dispatch()
+        return entry
+
+    def _dispatch(self):
+        with self.lock:
+            for entry in list(self.pending):
+                busy = list(self.running.values()) + list(self.abandoned.values())
+                if len(busy) >= TASK_MAX_WORKERS: break
+                t_type = entry['task'].get('type')
+                if sum(1 for e in busy if e['task'].get('type') == t_type) >= TASK_LIMITS.get(t_type, TASK_MAX_WORKERS): continue
+                self.pending.remove(entry)
+                entry['status'] = 'running'; entry['started'] = time.time()
+                self.running[id(entry)] = entry
+                threading.Thread(target=self._work, args=(entry,), daemon=True).start()
+
+    def _finish(self, entry, result, timed_out=False):
+        with self.lock:
+            if entry['finished']: # Already timed out or cancelled
+                if timed_out or self.abandoned.pop(id(entry), None) is None: return
+                result = None # The timed-out thread finally exited: free its slot, drop the late result
+            else:
+                entry['finished'] = True; self.running.pop(id(entry), None)
+                if entry in self.pending: self.pending.remove(entry)
+                if timed_out: entry['status'] = 'timed_out'; self.abandoned[id(entry)] = entry
+        try:
+            if result is not None: entry['on_done'](result)
+        finally: self._dispatch()
+
+    def _work(self, entry):
+        res = {"type": entry['task'].get('type'), "error": "task failed"}
+        try: res = handle_task(entry['task'], entry['progress']) or {"status": "ok"}
+        finally: self._finish(entry, res)
+
+    def _watch(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            with self.lock: running = list(self.running.values())
+            for entry in running:
+                limit = TASK_TIMEOUTS.get(entry['task'].get('type'), 600)
+                if now - entry['started'] > limit:
+                    entry['progress']['cancel'] = True # Cooperative stop; the thread's late result is discarded
+                    log_audit(f"Task timed out: {entry['task'].get('type')} {entry['task'].get('taskId')}")
+                    self._finish(entry, {"type": entry['task'].get('type'), "error": f"timed out after {limit}s", **self._counters(entry)}, timed_out=True)
+
+    def _counters(self, entry):
+        return {k: v for k, v in entry['progress'].items() if k != 'cancel'}
+
+    def cancel(self, task_id):
+        with self.lock:
+            entry = next((e for e in list(self.pending) + list(self.running.values()) if e['task'].get('taskId') == task_id), None)
+        if not entry: return {"type": "cancel", "taskId": task_id, "error": "unknown task"}
+        entry['progress']['cancel'] = True
+        if entry['status'] == 'queued':
+            self._finish(entry, {"type": entry['task'].get('type'), "status": "cancelled"})
+        return {"type": "cancel", "taskId": task_id, "status": "cancelling" if entry['status'] == 'running' else "cancelled"}
+
+    def progress(self):
+        with self.lock: entries = list(self.running.values()) + list(self.pending)
+        return {e['task']['taskId']: {'type': e['task'].get('type'), 'status': e['status'], 'started': e['started'], **self._counters(e)}
+                for e in entries if e['task'].get('taskId')}
+
+TASK_EXECUTOR = TaskExecutor()
+
+# --- Runtime timings ---
+# Opt-in (ANG_METRICS=1 or --metrics): rolling durations per collector and per endpoint,
+# exposed in Prometheus text format on /metrics.
+METRICS_ENABLED = os.environ.get('ANG_METRICS') == '1' or '--metrics' in sys.argv
+METRICS_WINDOW = 512
+RUNTIME_TIMINGS = {} # (kind, name) -> deque of seconds
+RUNTIME_COUNTS = collections.Counter()
+
+def record_timing(kind, name, seconds):
+    if not METRICS_ENABLED: return
+    key = (kind, name)
+    if key not in RUNTIME_TIMINGS: RUNTIME_TIMINGS[key] = collections.deque(maxlen=METRICS_WINDOW)
+    RUNTIME_TIMINGS[key].append(seconds); RUNTIME_COUNTS[key] += 1
+
+def percentiles(samples, qs=(0.5, 0.9, 0.99)):
+    ordered = sorted(samples)
+    return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs} if ordered else {}
+
+def render_metrics():
+    lines = ['# TYPE ang_duration_seconds summary']
+    for (kind, name), samples in sorted(list(RUNTIME_TIMINGS.items())):
+        labels = f'kind="{kind}",name="{name}"'
+        for q, v in percentiles(list(samples)).items(): lines.append(f'ang_duration_seconds{{{labels},quantile="{q}"}} {v:.6f}')
+        lines.append(f'ang_duration_seconds_count{{{labels}}} {RUNTIME_COUNTS[(kind, name)]}')
+    return '\n'.join(lines) + '\n'
+
+# --- Collector registry ---
+# Each metric family refreshes on its own period. ram/disk/process periods come from the
+# config "intervals" block (minutes); a ttl of None means "once per boot" (keyed on boot time).
+COLLECTORS = {}
+STATS_CACHE = {}
+
+def collector(name, interval_key=None, ttl=0, key=None):
+    def register(fn):
+        COLLECTORS[name] = {'fn': fn, 'interval_key': interval_key, 'ttl': ttl, 'key': key, 'lock': threading.Lock()}
+        return fn
+    return register
+
+def collector_ttl(name, cfg):
+    c = COLLECTORS[name]
+    if c['interval_key']:
+        try: return max(float(cfg.get('intervals', {}).get(c['interval_key'])) * 60, 1)
+        except: pass
+    return c['ttl']
+
+def collect(name, cfg):
+    c = COLLECTORS[name]; ttl = collector_ttl(name, cfg)
+    key = c['key'](cfg) if c['key'] else None
+    with c['lock']:
+        hit = STATS_CACHE.get(name); now = time.time()
+        if hit and hit['key'] == key and (ttl is None or now - hit['ts'] < ttl): return hit['value']
+        t0 = time.perf_counter()
+        try: value = c['fn'](cfg)
+        except Exception as e:
+            log_audit(f"Collector {name} failed: {e}")
+            return hit['value'] if hit else None
+        finally: record_timing('collector', name, time.perf_counter() - t0)
+        STATS_CACHE[name] = {'ts': now, 'key': key, 'value': value}
+        return value
+
+def on_config_change(new, old):
+    """Drop cached families whose inputs changed so the new settings show up on the next stats call."""
+    for name, c in COLLECTORS.items():
+        key = c['interval_key']
+        if key and new.get('intervals', {}).get(key) != old.get('intervals', {}).get(key): STATS_CACHE.pop(name, None)
+    if new.get('partitions') != old.get('partitions'): STATS_CACHE.pop('disks', None)
+
+CONFIG.subscribe(on_config_change)
+
+@collector('memory', interval_key='ram', ttl=300)
+def collect_memory(cfg):
+    mem = psutil.virtual_memory()
+    return {'memoryTotal': round(mem.total/(1024**3),2), 'memoryFree': round(mem.free/(1024**3),2), 'swapUsagePct': psutil.swap_memory().percent}
+
+@collector('disks', interval_key='disk', ttl=600, key=lambda cfg: tuple(p.get('path') for p in cfg.get('partitions', [])))
+def collect_disks(cfg):
+    disk_stats = []
     for p in cfg.get('partitions', []):
         try:
             u = psutil.disk_usage(p['path'])
             disk_stats.append({'path': p['path'], 'usage_pct': round(u.percent, 1), 'free_gb': round(u.free/(1024**3), 1), 'total_gb': round(u.total/(1024**3),1)})
         except: pass
-    procs = []
-    for pr in psutil.process_iter(['pid', 'name', 'memory_info', 'username']):
+    return disk_stats
+
+# --- Process sampler ---
+# Tracks processes across ticks keyed by (pid, starttime) and reads only /proc/<pid>/stat,
+# so CPU% and RSS growth come from deltas instead of a full psutil sweep.
+PROC_ROOT = '/proc'
+PROC_TOP_N = 10
+PROC_MIN_RSS_GB = 0.05
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+class ProcessSampler:
+    def __init__(self, root=PROC_ROOT):
+        self.root = root; self.prev = {}; self.prev_ts = None; self.users = {}
+
+    def _user(self, uid):
+        if uid not in self.users:
+            try: self.users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError: self.users[uid] = str(uid)
+        return self.users[uid]
+
+    def _read(self, pid):
+        with open(f"{self.root}/{pid}/stat", 'rb') as f: raw = f.read().decode(errors='replace')
+        name = raw[raw.index('(') + 1:raw.rindex(')')]
+        rest = raw[raw.rindex(')') + 2:].split() # rest[0] is field 3 (state)
+        return name, int(rest[11]) + int(rest[12]), int(rest[19]), int(rest[21]) * PAGE_SIZE
+
+    def sample(self, top_n=PROC_TOP_N):
+        now = time.monotonic(); dt = (now - self.prev_ts) if self.prev_ts else None
+        current = {}; rows = []
+        for entry in os.scandir(self.root):
+            if not entry.name.isdigit(): continue
+            pid = int(entry.name)
+            try:
+                name, ticks, start, rss = self._read(pid)
+                uid = entry.stat().st_uid
+            except (OSError, ValueError, IndexError): continue # Exited mid-scan or unreadable
+            key = (pid, start); current[key] = (ticks, rss)
+            prev = self.prev.get(key)
+            cpu = round(100.0 * (ticks - prev[0]) / CLK_TCK / dt, 1) if prev and dt else 0.0
+            growth = round((rss - prev[1]) / (1024**2) / dt, 3) if prev and dt else 0.0
+            rows.append((rss, growth, cpu, pid, name, uid))
+        self.prev = current; self.prev_ts = now
+        fmt = lambda r: {'pid': r[3], 'name': r[4], 'memGB': round(r[0] / (1024**3), 2), 'user': self._user(r[5]), 'cpuPct': r[2], 'rssGrowthMBs': r[1]}
+        top = heapq.nlargest(top_n, (r for r in rows if r[0] / (1024**3) > PROC_MIN_RSS_GB), key=lambda r: r[0])
+        growing = heapq.nlargest(5, (r for r in rows if r[1] > 0), key=lambda r: r[1])
+        return {'topProcesses': [fmt(r) for r in top], 'fastestGrowing': [fmt(r) for r in growing]}
+
+PROCESS_SAMPLER = ProcessSampler()
+
+@collector('processes', interval_key='process', ttl=300)
+def collect_processes(cfg):
+    return PROCESS_SAMPLER.sample()
+
+# --- Kernel log watcher ---
+# Follows /dev/kmsg (or a file of kmsg-formatted lines, for tests) on a background thread and
+# keeps OOM-kill and hung-task events in a bounded buffer. The last processed sequence number
+# and the buffer survive restarts via KMSG_STATE_PATH, so old events are not reported twice.
+KMSG_PATH = '/dev/kmsg'
+KMSG_MAX_EVENTS = 200
+OOM_RECENT_SECONDS = 3600 # oomDetected stays set this long after the last OOM kill
+OOM_KILL_RE = re.compile(r"Killed process (\d+) \(([^)]*)\).*?anon-rss:(\d+)kB(?:, file-rss:(\d+)kB)?(?:, shmem-rss:(\d+)kB)?")
+HUNG_TASK_RE = re.compile(r"INFO: task (.+):(\d+) blocked for more than (\d+) seconds")
+
+def parse_kmsg_line(line, boot_time):
+    """Parse one 'prio,seq,usec,flags;message' record; returns (seq, event or None)."""
+    head, _, msg = line.partition(';')
+    fields = head.split(',')
+    if len(fields) < 3: return None, None
+    try: seq, usec = int(fields[1]), int(fields[2])
+    except ValueError: return None, None
+    msg = msg.rstrip('\n'); ts = datetime.datetime.fromtimestamp(boot_time + usec / 1e6).isoformat()
+    m = OOM_KILL_RE.search(msg)
+    if m:
+        rss = sum(int(g) for g in m.groups()[2:] if g)
+        return seq, {'id': seq, 'boot': boot_time, 'type': 'oom_kill', 'pid': int(m.group(1)), 'name': m.group(2), 'rssKB': rss, 'timestamp': ts, 'epoch': boot_time + usec / 1e6, 'message': msg}
+    m = HUNG_TASK_RE.search(msg)
+    if m:
+        return seq, {'id': seq, 'boot': boot_time, 'type': 'hung_task', 'pid': int(m.group(2)), 'name': m.group(1), 'blockedSeconds': int(m.group(3)), 'timestamp': ts, 'epoch': boot_time + usec / 1e6, 'message': msg}
+    return seq, None
+
+class KernelLogWatcher:
+    def __init__(self, path=KMSG_PATH, state_path=KMSG_STATE_PATH):
+        self.path = path; self.state_path = state_path; self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=KMSG_MAX_EVENTS)
+        self.boot_time = psutil.boot_time(); self.last_seq = -1; self.last_saved = 0
+        self.thread = None; self.failed = False
         try:
-            m = round(pr.info['memory_info'].rss / (1024**3), 2)
-            if m > 0.05: procs.append({'pid': pr.info['pid'], 'name': pr.info['name'], 'memGB': m, 'user': pr.info['username']})
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            continue # Skip processes that no longer exist or are inaccessible
+            with open(state_path) as f: state = json.load(f)
+            if abs(state.get('boot_time', 0) - self.boot_time) < 5: # Sequence numbers restart on reboot
+                self.last_seq = state.get('seq', -1); self.events.extend(state.get('events', []))
+        except (OSError, ValueError): pass
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self._run, daemon=True); self.thread.start()
+        return self
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with self.lock: state = {'boot_time': self.boot_time, 'seq': self.last_seq, 'events': list(self.events)}
+            with open(self.state_path + '.tmp', 'w') as f: json.dump(state, f)
+            os.replace(self.state_path + '.tmp', self.state_path)
+            self.last_saved = time.time()
+        except OSError: pass
+
+    def _handle(self, line):
+        seq, event = parse_kmsg_line(line, self.boot_time)
+        if seq is None or seq <= self.last_seq: return
+        with self.lock:
+            self.last_seq = seq
+            if event: self.events.append(event)
+        if event or time.time() - self.last_saved > 60: self._save()
+
+    def _run(self):
+        try:
+            if os.path.isfile(self.path): self._follow_file()
+            else: self._follow_device()
         except Exception as e:
-            log_audit(f"Error getting process info: {e}")
-            continue
+            self.failed = True; log_audit(f"Kernel log watcher stopped: {e}")
 
-    # Get IP address
-    ip_address = 'N/A'
-    try:
-        # This will get the internal IP on Fly.io or local IP
-        # For public IP, usually requires external service. '0.0.0.0' for binding.
-        ip_address = subprocess.check_output(['hostname', '-I']).decode().split()[0]
-    except:
-        pass # If command fails, keep N/A
+    def _follow_device(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            while True:
+                try: rec = os.read(fd, 8192) # One record per read; blocks until the next message
+                except BrokenPipeError: continue # Ring buffer overwrote unread records; resume at the oldest
+                if rec: self._handle(rec.decode(errors='replace'))
+        finally: os.close(fd)
 
+    def _follow_file(self):
+        with open(self.path, errors='replace') as f:
+            while True:
+                line = f.readline()
+                if line: self._handle(line)
+                else: time.sleep(0.5)
 
-    return {
-        'agentId': AGENT_ID, 'customerName': cfg.get('customerName'),
-        'memoryTotal': round(mem.total/(1024**3),2), 'memoryFree': round(mem.free/(1024**3),2),
-        'swapUsagePct': psutil.swap_memory().percent, 'diskStats': disk_stats,
-        'topProcesses': sorted(procs, key=lambda x: x['memGB'], reverse=True)[:10],
-        'oomDetected': "Out of memory" in os.popen("dmesg | tail -n 20").read(),
-        'serverInfo': get_detailed_server_info(), 
+    def events_since(self, seq):
+        with self.lock: return [e for e in self.events if e['id'] > seq]
+
+    def recent_oom(self, within=OOM_RECENT_SECONDS):
+        now = time.time()
+        with self.lock: return next((e for e in reversed(self.events) if e['type'] == 'oom_kill' and now - e['epoch'] < within), None)
+
+KMSG_WATCHER = None
+
+def kernel_log_watcher():
+    global KMSG_WATCHER
+    if KMSG_WATCHER is None: KMSG_WATCHER = KernelLogWatcher().start()
+    return KMSG_WATCHER
+
+@collector('oom', ttl=10)
+def collect_oom(cfg):
+    watcher = kernel_log_watcher()
+    if watcher.failed: # No readable /dev/kmsg (e.g. unprivileged container): fall back to dmesg
+        return {'detected': "Out of memory" in os.popen("dmesg | tail -n 20").read(), 'last': None}
+    last = watcher.recent_oom()
+    return {'detected': last is not None, 'last': last}
+
+@collector('ip', ttl=300)
+def collect_ip(cfg):
+    # This will get the internal IP on Fly.io or local IP
+    # For public IP, usually requires external service. '0.0.0.0' for binding.
+    try: return subprocess.check_output(['hostname', '-I']).decode().split()[0]
+    except: return 'N/A'
+
+@collector('serverInfo', ttl=None, key=lambda cfg: psutil.boot_time())
+def collect_server_info(cfg):
+    return get_detailed_server_info()
+
+def get_stats():
+    cfg = load_config()
+    stats = {'agentId': AGENT_ID, 'customerName': cfg.get('customerName')}
+    stats.update(collect('memory', cfg) or {})
+    procs = collect('processes', cfg) or {}; oom = collect('oom', cfg) or {}
+    stats.update({
+        'diskStats': collect('disks', cfg) or [],
+        'topProcesses': procs.get('topProcesses', []),
+        'fastestGrowing': procs.get('fastestGrowing', []),
+        'oomDetected': oom.get('detected', False),
+        'lastOomEvent': oom.get('last'),
+        'serverInfo': collect('serverInfo', cfg) or {},
         'config': cfg,
-        'ipAddress': ip_address,
+        'ipAddress': collect('ip', cfg) or 'N/A',
         'lastUpdate': datetime.datetime.now().isoformat()
-    }
+    })
+    return stats
+
+# --- Alert engine ---
+# Evaluates memory, partition and OOM rules against stats samples on its own thread. A rule
+# fires when its threshold is crossed and clears only once it recovers past a hysteresis band;
+# per-rule cooldown state is persisted so restarts do not re-send. Alerts raised within
+# ALERT_BATCH_SECONDS go out as one digest over a reused SMTP connection.
+ALERT_BATCH_SECONDS = 30
+ALERT_MEM_HYSTERESIS = 0.10 # Memory alert clears at threshold * (1 + this)
+ALERT_DISK_HYSTERESIS = 5 # Partition alert clears this many percentage points below threshold
+SMTP_IDLE_SECONDS = 300
+
+class SmtpPool:
+    def __init__(self):
+        self.conn = None; self.key = None; self.last_used = 0
+
+    def _connect(self, em):
+        host, port = em.get('smtpServer'), int(em.get('port') or 587)
+        if port == 465: conn = smtplib.SMTP_SSL(host, port, timeout=30)
+        else:
+            conn = smtplib.SMTP(host, port, timeout=30)
+            if em.get('useTLS', True): conn.starttls()
+        if em.get('username'): conn.login(em['username'], em.get('token', ''))
+        return conn
+
+    def send(self, em, msg):
+        key = (em.get('smtpServer'), em.get('port'), em.get('username'), em.get('useTLS'))
+        if self.conn and (key != self.key or time.time() - self.last_used > SMTP_IDLE_SECONDS): self.close()
+        for attempt in (0, 1): # A pooled connection may have been dropped by the server; retry once fresh
+            if not self.conn: self.conn = self._connect(em); self.key = key
+            try:
+                self.conn.send_message(msg); self.last_used = time.time(); return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPSenderRefused, socket.error):
+                self.close()
+                if attempt: raise
+
+    def close(self):
+        if self.conn:
+            try: self.conn.quit()
+            except Exception: pass
+        self.conn = None
+
+def evaluate_rules(stats, cfg, state):
+    """Update per-rule firing state from one stats sample; returns newly raised or still-firing alerts."""
+    alerts = []
+    def check(key, over, recovered, text):
+        rule = state.setdefault(key, {'firing': False, 'last_sent': 0, 'since': time.time()})
+        if over: rule['firing'] = True
+        elif recovered: rule['firing'] = False
+        if rule['firing']: alerts.append({'key': key, 'text': text})
+    try:
+        limit = float(cfg.get('memoryThresholdGB') or 0); free = stats.get('memoryFree')
+        if limit and free is not None:
+            check('memory', free < limit, free >= limit * (1 + ALERT_MEM_HYSTERESIS), f"Free memory {free} GB is below {limit} GB")
+    except (TypeError, ValueError): pass
+    usage = {d['path']: d for d in stats.get('diskStats', [])}
+    for p in cfg.get('partitions', []):
+        d = usage.get(p.get('path'))
+        if not p.get('enabled', True) or not d: continue
+        try: limit = float(p.get('threshold', 90))
+        except (TypeError, ValueError): continue
+        check(f"disk:{p['path']}", d['usage_pct'] >= limit, d['usage_pct'] < limit - ALERT_DISK_HYSTERESIS,
+              f"Partition {p['path']} is {d['usage_pct']}% full (threshold {limit}%, {d.get('free_gb')} GB free)")
+    oom = stats.get('lastOomEvent')
+    if oom:
+        key = f"oom:{oom.get('boot')}:{oom.get('id')}" # One-shot per kernel event
+        if key not in state: check(key, True, False, f"OOM killer ended {oom.get('name')} (pid {oom.get('pid')}, {oom.get('rssKB')} kB RSS) at {oom.get('timestamp')}")
+    return alerts
+
+class AlertEngine:
+    def __init__(self, state_path=ALERT_STATE_PATH):
+        self.state_path = state_path; self.samples = queue.Queue(maxsize=1); self.smtp = SmtpPool()
+        self.pending = {}; self.batch_started = None; self.thread = None; self.config_changed = False
+        try:
+            with open(state_path) as f: self.state = json.load(f)
+        except (OSError, ValueError): self.state = {}
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self._run, daemon=True); self.thread.start()
+        return self
+
+    def submit(self, stats, cfg):
+        """Hand a sample to the engine without blocking; an unprocessed older sample is replaced."""
+        try: self.samples.get_nowait()
+        except queue.Empty: pass
+        try: self.samples.put_nowait((stats, cfg))
+        except queue.Full: pass
+
+    def on_config_change(self, new, old):
+        self.config_changed = True # Pruned on the engine thread, which owns self.state
+
+    def _prune_rules(self, cfg):
+        enabled = {f"disk:{p.get('path')}" for p in cfg.get('partitions', []) if p.get('enabled', True)}
+        for key in [k for k in self.state if k.startswith('disk:') and k not in enabled]:
+            self.state.pop(key); self.pending.pop(key, None)
+        if not cfg.get('memoryThresholdGB'): self.state.pop('memory', None); self.pending.pop('memory', None)
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            for key in [k for k, v in self.state.items() if k.startswith('oom:') and time.time() - v.get('since', 0) > 7 * 86400]: self.state.pop(key)
+            with open(self.state_path + '.tmp', 'w') as f: json.dump(self.state, f)
+            os.replace(self.state_path + '.tmp', self.state_path)
+        except OSError as e: log_audit(f"Alert state save error: {e}")
+
+    def _run(self):
+        while True:
+            wait = max(0.1, ALERT_BATCH_SECONDS - (time.time() - self.batch_started)) if self.pending else 5
+            try: stats, cfg = self.samples.get(timeout=min(wait, 5))
+            except queue.Empty: stats = None
+            try:
+                if stats is not None: self.process(stats, cfg)
+                if self.pending and time.time() - self.batch_started >= ALERT_BATCH_SECONDS: self.flush()
+                elif not self.pending and self.smtp.conn and time.time() - self.smtp.last_used > SMTP_IDLE_SECONDS: self.smtp.close()
+            except Exception as e: log_audit(f"Alert engine error: {e}")
+
+    def process(self, stats, cfg):
+        before = json.dumps(self.state, sort_keys=True)
+        if self.config_changed: self.config_changed = False; self._prune_rules(cfg)
+        cooldown = float(cfg.get('email', {}).get('alertCooldownHours') or 0) * 3600; now = time.time()
+        for alert in evaluate_rules(stats, cfg, self.state):
+            if now - self.state[alert['key']]['last_sent'] >= cooldown and alert['key'] not in self.pending:
+                if not self.pending: self.batch_started = now
+                self.pending[alert['key']] = alert
+        self.cfg = cfg; self.stats = stats
+        if json.dumps(self.state, sort_keys=True) != before: self._save()
+
+    def flush(self):
+        em = self.cfg.get('email', {}); alerts = list(self.pending.values()); self.pending = {}
+        recipients = [r.strip() for r in str(em.get('recipients', '')).split(',') if r.strip()]
+        if not em.get('smtpServer') or not recipients: return
+        kind = 'Memory' if all(a['key'] == 'memory' for a in alerts) else 'Disk' if all(a['key'].startswith('disk:') for a in alerts) else 'Monitor'
+        server = self.stats.get('ipAddress', socket.gethostname())
+        msg = EmailMessage()
+        msg['Subject'] = em.get('subjectTemplate', "{type} Alert: {customer} on {server}").format(type=kind, customer=self.cfg.get('customerName'), server=server)
+        msg['From'] = em.get('username') or f"ang-monitor@{socket.gethostname()}"
+        msg['To'] = ', '.join(recipients)
+        msg.set_content(f"{len(alerts)} alert(s) for {self.cfg.get('customerName')} ({server}) at {datetime.datetime.now().isoformat()}:\n\n" + '\n'.join(f"- {a['text']}" for a in alerts))
+        try:
+            self.smtp.send(em, msg)
+            for a in alerts: self.state[a['key']]['last_sent'] = time.time()
+            self._save(); log_audit(f"Alert digest sent: {', '.join(a['key'] for a in alerts)}")
+        except Exception as e: log_audit(f"Alert email error: {e}")
+
+ALERT_ENGINE = AlertEngine()
+CONFIG.subscribe(ALERT_ENGINE.on_config_change)
+
+# --- Agent task channel ---
+TASK_RESULTS = {} # taskId -> result (None while running); makes redelivered tasks idempotent
+TASK_RESULTS_LOCK = threading.Lock()
+TASK_RESULTS_MAX = 256
+
+def post_result(task, res, final=True):
+    body = {'agentId': AGENT_ID, 'taskId': task.get('taskId'), 'result': res, 'final': final}
+    req = urllib.request.Request(f"{HUB_URL}/hub/result", data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    urllib.request.urlopen(req, timeout=5).close()
+
+def run_tasks(tasks):
+    for task in tasks:
+        tid = task.get('taskId')
+        with TASK_RESULTS_LOCK:
+            if tid and tid in TASK_RESULTS:
+                res = TASK_RESULTS[tid]
+                if res is None: continue # Still running on the other channel
+                duplicate = True
+            else:
+                duplicate = False
+                if tid:
+                    TASK_RESULTS[tid] = None
+                    while len(TASK_RESULTS) > TASK_RESULTS_MAX: TASK_RESULTS.pop(next(iter(TASK_RESULTS)))
+        if not duplicate and task.get('type') in POOLED_TASKS:
+            TASK_EXECUTOR.submit(task, lambda res, task=task: finish_task(task, res))
+            if task.get('type') in LONG_TASKS:
+                try: post_result(task, {"type": task.get('type'), "status": "accepted", "taskId": tid}, final=False)
+                except Exception as e: log_audit(f"Agent result post error: {e}")
+            continue
+        if not duplicate:
+            res = handle_task(task) or {"status": "ok"}
+        finish_task(task, res, store=not duplicate) # Re-sent for duplicates so the hub can acknowledge them
+
+def finish_task(task, res, store=True):
+    if store and task.get('taskId'):
+        with TASK_RESULTS_LOCK: TASK_RESULTS[task['taskId']] = res
+    try: post_result(task, res)
+    except Exception as e: log_audit(f"Agent result post error: {e}")
+
+# --- Heartbeat protocol v2 ---
+# config and serverInfo travel only when their hash changes; stats travel as a top-level
+# delta against the last snapshot the hub acknowledged. The hub answers with 'protocol',
+# 'ack' (or 'resync') and the body encodings it accepts.
+HEARTBEAT_PROTOCOL = 2
+COMPRESS_MIN_BYTES = 256
+
+def payload_hash(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def supported_encodings():
+    return (['zstd'] if zstandard else []) + ['gzip']
+
+def compress_body(body, encoding):
+    if encoding == 'zstd': return zstandard.ZstdCompressor().compress(body)
+    if encoding == 'gzip': return gzip.compress(body, compresslevel=6)
+    return body
+
+HEARTBEAT_MAX_BODY = 4 * 1024 * 1024 # Decompressed; bounds what one small upload can inflate to
+
+def decompress_body(body, encoding, limit=HEARTBEAT_MAX_BODY):
+    """Inflate at most limit bytes. ValueError for an unsupported encoding, OverflowError past the cap."""
+    if encoding in ('identity', ''): out = body
+    elif encoding == 'gzip':
+        with gzip.GzipFile(fileobj=io.BytesIO(body)) as f: out = f.read(limit + 1)
+    elif encoding == 'zstd' and zstandard:
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as f: out = f.read(limit + 1)
+    else: raise ValueError(f"unsupported Content-Encoding: {encoding}")
+    if len(out) > limit: raise OverflowError(f"body exceeds {limit} bytes")
+    return out
+
+class HeartbeatEncoder:
+    def __init__(self):
+        self.protocol = 1 # Legacy full payloads until the hub advertises v2
+        self.encoding = 'identity'
+        self.seq = 0
+        self.acked_seq = None; self.acked_stats = None; self.acked_hashes = {}
+        self.pending = None
+
+    def encode(self, cfg, stats):
+        if self.protocol < HEARTBEAT_PROTOCOL:
+            return json.dumps({'current_config': cfg, 'stats': stats}).encode(), {}
+        stats = dict(stats); info = stats.pop('serverInfo', {}); stats.pop('config', None)
+        hashes = {'config': payload_hash(cfg), 'info': payload_hash(info)}
+        self.seq += 1
+        payload = {'v': HEARTBEAT_PROTOCOL, 'seq': self.seq, 'config_hash': hashes['config'], 'info_hash': hashes['info']}
+        if hashes['config'] != self.acked_hashes.get('config'): payload['config'] = cfg
+        if hashes['info'] != self.acked_hashes.get('info'): payload['serverInfo'] = info
+        if self.acked_stats is None: payload['stats'] = stats
+        else:
+            payload['base'] = self.acked_seq
+            payload['delta'] = {'set': {k: v for k, v in stats.items() if self.acked_stats.get(k) != v},
+                                'del': [k for k in self.acked_stats if k not in stats]}
+        self.pending = (self.seq, stats, hashes)
+        body = json.dumps(payload, separators=(',', ':')).encode()
+        if self.encoding != 'identity' and len(body) >= COMPRESS_MIN_BYTES:
+            return compress_body(body, self.encoding), {'Content-Encoding': self.encoding}
+        return body, {}
+
+    def on_response(self, data):
+        if data.get('protocol', 1) >= HEARTBEAT_PROTOCOL: self.protocol = HEARTBEAT_PROTOCOL
+        accepted = data.get('encodings', [])
+        self.encoding = next((e for e in supported_encodings() if e in accepted), 'identity')
+        if data.get('resync'):
+            self.acked_seq = None; self.acked_stats = None; self.acked_hashes = {}
+        elif self.pending and data.get('ack') == self.pending[0]:
+            self.acked_seq, self.acked_stats, self.acked_hashes = self.pending
+        self.pending = None
+
+def agent_task_loop():
+    backoff = 1
+    while True:
+        try:
+            req = urllib.request.Request(f"{HUB_URL}/hub/poll?agentId={AGENT_ID}&wait={TASK_POLL_WAIT}", headers={'X-Agent-ID': AGENT_ID})
+            with urllib.request.urlopen(req, timeout=TASK_POLL_WAIT + 10) as resp:
+                data = json.loads(resp.read().decode())
+            backoff = 1
+            run_tasks(data.get('tasks', []))
+        except Exception as e:
+            log_audit(f"Agent task poll error: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
 
 def agent_push_loop():
     print(f"ANG Agent (ID: {AGENT_ID}) Loop Active...")
+    threading.Thread(target=agent_task_loop, daemon=True).start()
+    ALERT_ENGINE.start()
+    encoder = HeartbeatEncoder(); events_sent = -1
     while True:
         try:
-            cfg = load_config()
-            # Localhost loopback
-            hub = "http://127.0.0.1:9090"
-            payload = {'current_config': cfg, 'stats': get_stats()}
-            req = urllib.request.Request(f"{hub}/hub/heartbeat", data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json', 'X-Agent-ID': AGENT_ID})
-            with urllib.request.urlopen(req, timeout=5) as resp:
-                data = json.loads(resp.read().decode())
-                for task in data.get('tasks', []):
-                    res = handle_task(task)
-                    if res:
-                        res_req = urllib.request.Request(f"{hub}/hub/result", data=json.dumps({'agentId': AGENT_ID, 'result': res}).encode(), headers={'Content-Type': 'application/json'})
-                        urllib.request.urlopen(res_req, timeout=5)
+            cfg = load_config(); stats = get_stats()
+            ALERT_ENGINE.submit(stats, cfg)
+            stats['taskProgress'] = TASK_EXECUTOR.progress()
+            stats['kernelEvents'] = kernel_log_watcher().events_since(events_sent) # New events only
+            body, extra_headers = encoder.encode(cfg, stats)
+            req = urllib.request.Request(f"{HUB_URL}/hub/heartbeat", data=body, headers={'Content-Type': 'application/json', 'X-Agent-ID': AGENT_ID, **extra_headers})
+            try:
+                with urllib.request.urlopen(req, timeout=5) as resp:
+                    data = json.loads(resp.read().decode())
+            except Exception:
+                encoder.on_response({'resync': True, 'protocol': encoder.protocol}) # Unknown delivery state: next beat is full
+                raise
+            encoder.on_response(data)
+            if not data.get('resync') and stats['kernelEvents']: events_sent = stats['kernelEvents'][-1]['id']
+            run_tasks(data.get('tasks', [])) # Fallback path; normally empty since tasks go out via /hub/poll
         except Exception as e:
             log_audit(f"Agent push loop error: {e}")
             pass
-        time.sleep(2)
+        time.sleep(HEARTBEAT_INTERVAL)
+
+# --- Hub task queue (callers hold HUB_LOCK) ---
+def hub_agent(aid):
+    if aid not in HUB_AGENTS:
+        HUB_AGENTS[aid] = {'tasks': [], 'stats': {}, 'last_result': None, 'last_seen': time.time()}
+        if len(HUB_AGENTS) > HUB_MAX_AGENTS: hub_expire_agents(keep=aid)
+    HUB_AGENTS[aid].setdefault('inflight', {})
+    return HUB_AGENTS[aid]
+
+def hub_queue_task(aid, task):
+    task = dict(task); task.setdefault('taskId', uuid.uuid4().hex)
+    queued = HUB_AGENTS[aid].setdefault('tasks', [])
+    if len(queued) >= HUB_MAX_TASKS_PER_AGENT: return None
+    queued.append(task)
+    HUB_STATE.log({'op': 'task', 'aid': aid, 'task': task})
+    if aid in HUB_WAITERS: HUB_WAITERS[aid].notify_all()
+    return task['taskId']
+
+def hub_deliver_tasks(aid):
+    agent = hub_agent(aid); now = time.time()
+    expired = [t for t in agent['inflight'].values() if now - t['delivered'] > TASK_ACK_TIMEOUT]
+    tasks = [t['task'] for t in expired] + agent.pop('tasks', [])
+    agent['tasks'] = []
+    for t in tasks:
+        agent['inflight'][t['taskId']] = {'task': t, 'delivered': now}
+        job = HUB_JOBS.get(t.get('jobId'))
+        if job and job['agents'].get(aid, {}).get('status') == 'queued': job['agents'][aid]['status'] = 'delivered'
+    return tasks
+
+# --- Hub state persistence and limits (callers hold HUB_LOCK) ---
+# Queued/in-flight tasks, last results and agent identity survive restarts through a snapshot
+# file plus a JSON-lines write-ahead log of task/ack/result operations. Replay is idempotent, so a
+# crash between writing the snapshot and dropping the rotated log is harmless.
+HUB_AGENT_TTL = 7 * 86400 # Agents silent for longer than this are forgotten
+HUB_MAX_AGENTS = 10000
+HUB_MAX_TASKS_PER_AGENT = 100
+HUB_MAX_RESULT_BYTES = 4 * 1024 * 1024
+HUB_SNAPSHOT_EVERY = 60
+HUB_PERSISTED_KEYS = ('tasks', 'inflight', 'last_result', 'last_seen', 'config', 'stats', 'kernelEvents')
+HUB_INTERNAL_KEYS = ('heartbeat', 'inflight') # Decoder state and delivery bookkeeping; not part of the agent detail view
+
+class HubStateStore:
+    def __init__(self, root=HUB_STATE_PATH):
+        self.root = root; self.wal = None; self.dirty = False
+        self.snapshot_path = os.path.join(root, 'snapshot.json')
+        self.wal_path = os.path.join(root, 'wal.jsonl'); self.prev_wal_path = self.wal_path + '.prev'
+
+    def log(self, op):
+        if not self.wal: return # Persistence not enabled (e.g. benchmarks, imports)
+        try:
+            self.wal.write(json.dumps(op, separators=(',', ':')) + '\n'); self.wal.flush(); self.dirty = True
+        except (OSError, TypeError, ValueError) as e: log_audit(f"Hub WAL write error: {e}")
+
+    def _replay(self, path):
+        try: f = open(path)
+        except OSError: return
+        with f:
+            for line in f:
+                try: op = json.loads(line)
+                except ValueError: continue # Torn final line from a crash
+                agent = hub_agent(op['aid'])
+                if op['op'] == 'task' and not any(t.get('taskId') == op['task']['taskId'] for t in agent['tasks']) and op['task']['taskId'] not in agent['inflight']:
+                    agent['tasks'].append(op['task'])
+                elif op['op'] == 'ack': agent['inflight'].pop(op['taskId'], None); agent['tasks'] = [t for t in agent['tasks'] if t.get('taskId') != op['taskId']]
+                elif op['op'] == 'result': agent['last_result'] = op['result']
+
+    def recover(self):
+        os.makedirs(self.root, exist_ok=True)
+        with HUB_LOCK:
+            try:
+                with open(self.snapshot_path) as f: HUB_AGENTS.update(json.load(f))
+            except (OSError, ValueError): pass
+            self._replay(self.prev_wal_path); self._replay(self.wal_path)
+            for agent in HUB_AGENTS.values(): # Undelivered-or-unacked tasks go back on the queue
+                agent.setdefault('tasks', [])[:0] = [t['task'] for t in agent.pop('inflight', {}).values()]
+                agent['inflight'] = {}
+            self.wal = open(self.wal_path, 'a')
+        self.snapshot()
+        log_audit(f"Hub state recovered: {len(HUB_AGENTS)} agents")
+
+    def snapshot(self):
+        if not self.wal: return
+        with HUB_LOCK:
+            data = json.dumps({aid: {k: a[k] for k in HUB_PERSISTED_KEYS if k in a} for aid, a in HUB_AGENTS.items()})
+            self.wal.close(); os.replace(self.wal_path, self.prev_wal_path)
+            self.wal = open(self.wal_path, 'a'); self.dirty = False
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'w') as f: f.write(data); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        try: os.remove(self.prev_wal_path)
+        except OSError: pass
+
+HUB_STATE = HubStateStore()
+
+def hub_expire_agents(now=None, keep=None):
+    now = now or time.time()
+    expired = [aid for aid, a in HUB_AGENTS.items() if aid != keep and now - a.get('last_seen', now) > HUB_AGENT_TTL]
+    overflow = len(HUB_AGENTS) - len(expired) - HUB_MAX_AGENTS
+    if overflow > 0: # Still over the cap: drop the longest-silent agents, never the one being added
+        alive = sorted((a.get('last_seen', 0), aid) for aid, a in HUB_AGENTS.items() if aid not in expired and aid != keep)
+        expired += [aid for _, aid in alive[:overflow]]
+    for aid in expired:
+        HUB_AGENTS.pop(aid, None); HUB_WAITERS.pop(aid, None)
+        hub_fail_job_entries('agent expired', aid=aid)
+        HUB_TSDB.forget(aid)
+    if expired: HUB_STATE.dirty = True
+    return expired
+
+def hub_store_result(aid, task_id, result, final=True):
+    size = len(json.dumps(result))
+    if size > HUB_MAX_RESULT_BYTES: result = {'error': f"result too large ({size} bytes)", 'type': (result or {}).get('type')}
+    HUB_AGENTS[aid]['last_result'] = result
+    HUB_AGENTS[aid].get('inflight', {}).pop(task_id, None) # Acknowledge delivery; an 'accepted' result counts too
+    HUB_STATE.log({'op': 'ack', 'aid': aid, 'taskId': task_id})
+    HUB_STATE.log({'op': 'result', 'aid': aid, 'result': result})
+    hub_job_result(aid, task_id, result, final)
+
+def hub_agent_summary(aid, agent):
+    stats = agent.get('stats') or {}; cfg = agent.get('config') or {}
+    disks = [d.get('usage_pct', 0) for d in stats.get('diskStats') or []]
+    return {'agentId': aid, 'customerName': cfg.get('customerName') or stats.get('customerName'), 'last_seen': agent.get('last_seen'),
+            'ipAddress': stats.get('ipAddress'), 'memoryTotal': stats.get('memoryTotal'), 'memoryFree': stats.get('memoryFree'),
+            'swapUsagePct': stats.get('swapUsagePct'), 'maxDiskPct': max(disks) if disks else None, 'oomDetected': stats.get('oomDetected'),
+            'pendingTasks': len(agent.get('tasks') or []) + len(agent.get('inflight') or {}), 'hasResult': agent.get('last_result') is not None}
+
+def hub_maintenance_loop():
+    while True:
+        time.sleep(HUB_SNAPSHOT_EVERY)
+        try:
+            with HUB_LOCK: hub_expire_agents(); hub_evict_jobs()
+            if HUB_STATE.dirty: HUB_STATE.snapshot()
+            if time.time() - HUB_TSDB.last_prune > TS_PRUNE_EVERY: HUB_TSDB.prune()
+        except Exception as e: log_audit(f"Hub maintenance error: {e}")
+
+# --- Fleet fan-out jobs (callers hold HUB_LOCK) ---
+HUB_JOBS = {} # jobId -> job, in creation order
+HUB_JOBS_MAX = 100
+HUB_JOB_TTL = 3600 # Completed jobs are evicted this long after finishing
+HUB_JOB_DEADLINE = 1800 # Entries with no result or progress for this long are failed as timed out
+
+def hub_select_agents(selector):
+    """Agents matching every given selector field: agentIds list, customerName glob, tags subset."""
+    ids = selector.get('agentIds'); name = selector.get('customerName'); tags = set(selector.get('tags') or [])
+    picked = []
+    for aid, agent in HUB_AGENTS.items():
+        cfg = agent.get('config') or {}
+        if ids is not None and aid not in ids: continue
+        if name and not fnmatch.fnmatch(str(cfg.get('customerName', '')), name): continue
+        if tags and not tags.issubset(set(cfg.get('tags') or [])): continue
+        picked.append(aid)
+    return picked
+
+def hub_fail_job_entries(error, aid=None, before=None):
+    """Fail unfinished entries for one agent and/or not updated since `before`, so stuck jobs still finish."""
+    now = time.time()
+    for job in HUB_JOBS.values():
+        if job['finished']: continue
+        for entry_aid, e in job['agents'].items():
+            if e['status'] in ('done', 'error') or (aid is not None and entry_aid != aid) or (before is not None and e['updated'] >= before): continue
+            e.update({'status': 'error', 'result': {'error': error}, 'updated': now})
+        if all(e['status'] in ('done', 'error') for e in job['agents'].values()): job['finished'] = now
+
+def hub_evict_jobs():
+    now = time.time()
+    hub_fail_job_entries('timeout', before=now - HUB_JOB_DEADLINE)
+    for jid in [j for j, v in HUB_JOBS.items() if v['finished'] and now - v['finished'] > HUB_JOB_TTL]: HUB_JOBS.pop(jid)
+    for jid in [j for j, v in HUB_JOBS.items() if v['finished']][:max(0, len(HUB_JOBS) - HUB_JOBS_MAX + 1)]: HUB_JOBS.pop(jid)
+
+def hub_create_job(spec):
+    hub_evict_jobs()
+    if len(HUB_JOBS) >= HUB_JOBS_MAX: return None # Only running jobs left; refuse rather than grow
+    job = {'jobId': uuid.uuid4().hex[:12], 'type': spec.get('type'), 'args': spec.get('args', {}), 'created': time.time(), 'finished': None, 'agents': {}}
+    for aid in hub_select_agents(spec):
+        tid = hub_queue_task(aid, {'type': job['type'], 'args': job['args'], 'jobId': job['jobId']})
+        job['agents'][aid] = {'taskId': tid, 'status': 'queued' if tid else 'error', 'result': None if tid else {'error': 'task queue full'}, 'updated': time.time()}
+    if all(e['status'] == 'error' for e in job['agents'].values()): job['finished'] = time.time()
+    HUB_JOBS[job['jobId']] = job
+    return job
+
+def hub_job_result(aid, task_id, result, final=True):
+    for job in HUB_JOBS.values():
+        entry = job['agents'].get(aid)
+        if entry and entry['taskId'] == task_id:
+            if not final:
+                if entry['status'] in ('queued', 'delivered'): entry.update({'status': 'running', 'updated': time.time()})
+                return
+            entry.update({'status': 'error' if isinstance(result, dict) and 'error' in result else 'done', 'result': result, 'updated': time.time()})
+            if all(e['status'] in ('done', 'error') for e in job['agents'].values()): job['finished'] = time.time()
+            return
+
+def hub_job_progress(aid, stats):
+    progress = stats.get('taskProgress') or {}
+    if not progress: return
+    for job in HUB_JOBS.values():
+        entry = job['agents'].get(aid)
+        if entry and entry['taskId'] in progress and entry['status'] not in ('done', 'error'):
+            entry.update({'status': 'running', 'progress': progress[entry['taskId']], 'updated': time.time()})
+
+def hub_job_summary(job):
+    counts = collections.Counter(e['status'] for e in job['agents'].values())
+    summary = {'jobId': job['jobId'], 'type': job['type'], 'created': job['created'], 'finished': job['finished'], 'total': len(job['agents']), 'status': dict(counts)}
+    if job['type'] == 'scan_tune': # Which hosts are MISMATCH on which parameter
+        mismatch = {}
+        for aid, e in job['agents'].items():
+            for row in ((e['result'] or {}).get('data') or []) if e['status'] == 'done' else []:
+                if row.get('status') == 'MISMATCH': mismatch.setdefault(row['param'], []).append({'agentId': aid, 'current': row.get('current')})
+        summary['mismatch'] = mismatch
+    errors = collections.Counter(e['result']['error'] for e in job['agents'].values() if e['status'] == 'error')
+    if errors: summary['errors'] = dict(errors)
+    return summary
+
+def hub_merge_events(agent, stats):
+    events = agent.setdefault('kernelEvents', [])
+    last = (events[-1].get('boot', 0), events[-1]['id']) if events else (0, -1) # Sequence numbers restart on reboot
+    events.extend(e for e in stats.get('kernelEvents') or [] if (e.get('boot', 0), e.get('id', -1)) > last)
+    del events[:-KMSG_MAX_EVENTS]
+
+def hub_apply_heartbeat(aid, data):
+    """Merge a legacy or v2 heartbeat into HUB_AGENTS[aid]; returns the protocol reply fields."""
+    agent = hub_agent(aid)
+    reply = {'protocol': HEARTBEAT_PROTOCOL, 'encodings': supported_encodings()}
+    if data.get('v', 1) < HEARTBEAT_PROTOCOL:
+        agent.update({'last_seen': time.time(), 'stats': data['stats'], 'config': data['current_config']})
+        hub_merge_events(agent, data['stats'])
+        hub_job_progress(aid, data['stats'])
+        return reply
+    hb = agent.setdefault('heartbeat', {})
+    if 'config' in data: hb['config'] = data['config']; hb['config_hash'] = data['config_hash']
+    if 'serverInfo' in data: hb['serverInfo'] = data['serverInfo']; hb['info_hash'] = data['info_hash']
+    if 'stats' in data: hb['stats'] = data['stats']
+    elif 'delta' in data and hb.get('seq') == data.get('base') and 'stats' in hb:
+        stats = dict(hb['stats']); stats.update(data['delta'].get('set', {}))
+        for k in data['delta'].get('del', []): stats.pop(k, None)
+        hb['stats'] = stats
+    else: return dict(reply, resync=True)
+    if hb.get('config_hash') != data.get('config_hash') or hb.get('info_hash') != data.get('info_hash'):
+        return dict(reply, resync=True)
+    hb['seq'] = data['seq']
+    stats = dict(hb['stats'], config=hb['config'], serverInfo=hb['serverInfo'])
+    agent.update({'last_seen': time.time(), 'stats': stats, 'config': hb['config']})
+    hub_merge_events(agent, stats)
+    hub_job_progress(aid, stats)
+    return dict(reply, ack=data['seq'])
+
+def hub_wait_tasks(aid, wait):
+    deadline = time.time() + wait
+    cond = HUB_WAITERS.setdefault(aid, threading.Condition(HUB_LOCK))
+    with cond:
+        while True:
+            tasks = hub_deliver_tasks(aid)
+            remaining = deadline - time.time()
+            if tasks or remaining <= 0: return tasks
+            cond.wait(remaining)
+
+# --- Hub time-series store ---
+# Layout: TSDB_PATH/<tier>/<agent>/<metric>/<segment start>.seg. Each segment is a sparse,
+# memory-mapped file: a header (magic, record count) followed by fixed-size records.
+# raw records are (ts, value); 1m/1h rollups are (ts, min, max, sum, count).
+TS_RAW = struct.Struct('<dd')
+TS_ROLLUP = struct.Struct('<ddddd')
+TS_HEADER = struct.Struct('<4sI')
+TS_TIERS = { # tier -> (record format, bucket seconds, segment span seconds, retention config key)
+    'raw': (TS_RAW, 0, 86400, 'rawDays'),
+    '1m': (TS_ROLLUP, 60, 7 * 86400, 'minuteDays'),
+    '1h': (TS_ROLLUP, 3600, 90 * 86400, 'hourDays'),
+}
+TS_MIN_OPEN_SEGMENTS = 512
+TS_MAX_OPEN_SEGMENTS = 32768 # Each open segment is one mapping; stay well under vm.max_map_count (65530)
+TS_PRUNE_EVERY = 600
+
+class TimeSeriesSegment:
+    def __init__(self, path, rec, capacity):
+        self.rec = rec; self.capacity = capacity
+        size = TS_HEADER.size + rec.size * capacity
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size: os.ftruncate(fd, size) # Sparse until written
+            self.map = mmap.mmap(fd, size)
+        finally: os.close(fd)
+        magic, self.count = TS_HEADER.unpack_from(self.map, 0)
+        if magic != b'ANGT': self.count = 0; TS_HEADER.pack_into(self.map, 0, b'ANGT', 0)
+
+    def append(self, *values):
+        if self.count >= self.capacity: return False
+        self.rec.pack_into(self.map, TS_HEADER.size + self.count * self.rec.size, *values)
+        self.count += 1
+        TS_HEADER.pack_into(self.map, 0, b'ANGT', self.count)
+        return True
+
+    def records(self):
+        for i in range(self.count): yield self.rec.unpack_from(self.map, TS_HEADER.size + i * self.rec.size)
+
+    def close(self):
+        self.map.close()
+
+class TimeSeriesStore:
+    def __init__(self, root=TSDB_PATH):
+        self.root = root; self.lock = threading.Lock()
+        self.segments = {} # (tier, agent, metric, start) -> TimeSeriesSegment, in LRU order
+        self.buckets = {} # (tier, agent, metric) -> [bucket ts, min, max, sum, count]
+        self.last_prune = 0
+
+    def _segment(self, tier, agent, metric, ts, create=True):
+        rec, bucket, span, _ = TS_TIERS[tier]
+        start = int(ts // span * span)
+        key = (tier, agent, metric, start)
+        seg = self.segments.pop(key, None)
+        if seg is None:
+            path = os.path.join(self.root, tier, quote(agent, safe=''), quote(metric, safe=''), f"{start}.seg")
+            if not create and not os.path.exists(path): return None
+            seg = TimeSeriesSegment(path, rec, span // (bucket or 1))
+            # Sized to the fleet: every live series keeps a raw, 1m and 1h segment hot (two bucket entries per series)
+            limit = min(max(TS_MIN_OPEN_SEGMENTS, 2 * len(self.buckets)), TS_MAX_OPEN_SEGMENTS)
+            while len(self.segments) >= limit: self.segments.pop(next(iter(self.segments))).close()
+        self.segments[key] = seg
+        return seg
+
+    def record(self, agent, points, ts=None):
+        ts = ts or time.time()
+        with self.lock:
+            for metric, value in points.items():
+                self._segment('raw', agent, metric, ts).append(ts, value)
+                for tier in ('1m', '1h'):
+                    bucket_ts = ts // TS_TIERS[tier][1] * TS_TIERS[tier][1]
+                    b = self.buckets.get((tier, agent, metric))
+                    if b and b[0] != bucket_ts: # Bucket closed: roll it up to disk
+                        self._segment(tier, agent, metric, b[0]).append(*b); b = None
+                    if not b: self.buckets[(tier, agent, metric)] = [bucket_ts, value, value, value, 1]
+                    else: b[1] = min(b[1], value); b[2] = max(b[2], value); b[3] += value; b[4] += 1
+
+    def forget(self, agent):
+        """Flush an expired agent's open rollup buckets to disk and drop its in-memory state."""
+        with self.lock:
+            for key in [k for k in self.buckets if k[1] == agent]:
+                b = self.buckets.pop(key); self._segment(key[0], agent, key[2], b[0]).append(*b)
+            for key in [k for k in self.segments if k[1] == agent]: self.segments.pop(key).close()
+
+    def prune(self, now=None):
+        """Drop segments past retention. Runs from the hub maintenance loop; the lock is held only to close open maps."""
+        now = now or time.time(); self.last_prune = now
+        retention = load_config().get('history', {})
+        for tier, (_, _, span, days_key) in TS_TIERS.items():
+            try: cutoff = now - float(retention.get(days_key)) * 86400
+            except (TypeError, ValueError): continue
+            with self.lock:
+                for key in [k for k in self.segments if k[0] == tier and k[3] + span < cutoff]: self.segments.pop(key).close()
+            tier_dir = os.path.join(self.root, tier)
+            for dirpath, _, files in os.walk(tier_dir, topdown=False):
+                for f in files:
+                    try:
+                        if f.endswith('.seg') and int(f[:-4]) + span < cutoff: os.remove(os.path.join(dirpath, f))
+                    except (ValueError, OSError): pass
+                if dirpath != tier_dir: # Metric and agent directories left empty, e.g. by expired agents
+                    try: os.rmdir(dirpath)
+                    except OSError: pass # Not empty
+
+    def metrics(self, agent):
+        found = set()
+        for tier in TS_TIERS:
+            try: found.update(unquote(m) for m in os.listdir(os.path.join(self.root, tier, quote(agent, safe=''))))
+            except OSError: pass
+        return sorted(found)
+
+    def query(self, agent, metric, start, end, step):
+        """Return [ts, avg, min, max] per step bucket, answered from the coarsest tier that fits the step."""
+        tier = '1h' if step >= 3600 else '1m' if step >= 60 else 'raw'
+        span = TS_TIERS[tier][2]; out = {}
+        with self.lock:
+            rows = []
+            for seg_start in range(int(start // span * span), int(end) + 1, span):
+                seg = self._segment(tier, agent, metric, seg_start, create=False)
+                if seg: rows.extend(r for r in seg.records() if start <= r[0] <= end)
+            pending = self.buckets.get((tier, agent, metric)) if tier != 'raw' else None
+            if pending and start <= pending[0] <= end: rows.append(tuple(pending))
+        for r in rows:
+            ts, lo, hi, total, n = (r[0], r[1], r[1], r[1], 1) if tier == 'raw' else r
+            b = out.setdefault(int(ts // step * step), [lo, hi, 0.0, 0])
+            b[0] = min(b[0], lo); b[1] = max(b[1], hi); b[2] += total; b[3] += n
+        return {'tier': tier, 'points': [[ts, round(b[2] / b[3], 3), b[0], b[1]] for ts, b in sorted(out.items())]}
+
+def stats_metrics(stats):
+    points = {}
+    for key in ('memoryFree', 'swapUsagePct'):
+        if isinstance(stats.get(key), (int, float)): points[key] = float(stats[key])
+    if stats.get('memoryTotal'): points['memoryUsedPct'] = round(100 * (1 - stats.get('memoryFree', 0) / stats['memoryTotal']), 2)
+    for d in stats.get('diskStats', []) or []:
+        try:
+            points[f"disk:{d['path']}:usage_pct"] = float(d['usage_pct'])
+            points[f"disk:{d['path']}:free_gb"] = float(d['free_gb'])
+        except (KeyError, TypeError, ValueError): pass
+    return points
+
+HUB_TSDB = TimeSeriesStore()
 
 # Helper to determine MIME type for static files
 def get_mimetype(filepath):
@@ -277,9 +1704,141 @@ def get_mimetype(filepath):
         return 'application/octet-stream' # Default if unknown
     return mime_type
 
+# --- Server-Sent Events ---
+# One publisher thread per topic (live stats, or one hub agent) collects once per
+# STREAM_INTERVAL and fans frames out to every subscriber: a full 'snapshot' first, then
+# top-level 'delta' frames with only the changed fields. Each subscriber has a bounded queue;
+# a client that falls behind has its stale frames dropped and gets a fresh snapshot instead.
+STREAM_INTERVAL = 1.0
+STREAM_CLIENT_BUFFER = 8
+STREAM_KEEPALIVE = 15
+
+def stats_delta(old, new):
+    return {'set': {k: v for k, v in new.items() if old.get(k) != v}, 'del': [k for k in old if k not in new]}
+
+def sse_frame(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode()
+
+class StreamHub:
+    def __init__(self):
+        self.lock = threading.Lock(); self.topics = {} # name -> {'producer', 'subscribers', 'last'}
+
+    def subscribe(self, name, producer):
+        sub = queue.Queue(maxsize=STREAM_CLIENT_BUFFER)
+        with self.lock:
+            topic = self.topics.get(name)
+            if topic is None:
+                topic = self.topics[name] = {'producer': producer, 'subscribers': set(), 'last': None}
+                threading.Thread(target=self._publish, args=(name, topic), daemon=True).start()
+            topic['subscribers'].add(sub)
+            if topic['last'] is not None: sub.put_nowait(sse_frame('snapshot', topic['last']))
+        return sub
+
+    def unsubscribe(self, name, sub):
+        with self.lock:
+            topic = self.topics.get(name)
+            if topic: topic['subscribers'].discard(sub)
+
+    def _offer(self, sub, frame, snapshot):
+        try: sub.put_nowait(frame)
+        except queue.Full: # Slow client: drop what it has not read and resync it
+            try:
+                while True: sub.get_nowait()
+            except queue.Empty: pass
+            sub.put_nowait(sse_frame('snapshot', snapshot))
+
+    def _publish(self, name, topic):
+        while True:
+            with self.lock:
+                if not topic['subscribers']: # Last viewer left: stop collecting
+                    self.topics.pop(name, None); return
+            try: snapshot = topic['producer']()
+            except Exception as e:
+                log_audit(f"Stream {name} producer error: {e}"); snapshot = None
+            if snapshot is not None:
+                last = topic['last']
+                if last is None: frame = sse_frame('snapshot', snapshot)
+                else:
+                    delta = stats_delta(last, snapshot)
+                    frame = sse_frame('delta', delta) if delta['set'] or delta['del'] else None
+                with self.lock:
+                    topic['last'] = snapshot
+                    if frame:
+                        for sub in list(topic['subscribers']): self._offer(sub, frame, snapshot)
+            time.sleep(STREAM_INTERVAL)
+
+STREAMS = StreamHub()
+
+def hub_agent_stream(aid):
+    def producer():
+        with HUB_LOCK:
+            agent = HUB_AGENTS.get(aid)
+            return dict(agent.get('stats') or {}, last_seen=agent.get('last_seen')) if agent else {'gone': True}
+    return producer
+
+# --- Static asset cache ---
+# Dashboard files are loaded and gzip-compressed once, then re-read only when their mtime
+# changes (checked at most every STATIC_RECHECK_SECONDS). Files above STATIC_INMEM_MAX are
+# not held in memory and go out with sendfile instead.
+STATIC_FILES = ['index.html', 'index.tsx', 'App.tsx', 'types.ts', 'index.css', 'metadata.json', 'favicon.ico']
+STATIC_INMEM_MAX = 1024 * 1024
+STATIC_RECHECK_SECONDS = 2
+STATIC_CACHE_CONTROL = 'no-cache' # Unversioned file names: always revalidate, which the ETag makes a cheap 304
+STATIC_COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+class StaticAssetCache:
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or os.getcwd()); self.assets = {}; self.lock = threading.Lock()
+
+    def preload(self):
+        names = list(STATIC_FILES)
+        try: names += [f"components/{f}" for f in sorted(os.listdir(os.path.join(self.root, 'components')))]
+        except OSError: pass
+        for name in names: self.get(name)
+        return self
+
+    def _load(self, path, st):
+        mime = get_mimetype(path)
+        asset = {'path': path, 'mime': mime, 'mtime': st.st_mtime_ns, 'size': st.st_size, 'checked': time.time(), 'body': None, 'gzip': None}
+        if st.st_size <= STATIC_INMEM_MAX:
+            with open(path, 'rb') as f: asset['body'] = f.read()
+            asset['etag'] = '"' + hashlib.sha1(asset['body']).hexdigest() + '"'
+            if mime.startswith(STATIC_COMPRESSIBLE) and st.st_size > 256:
+                packed = gzip.compress(asset['body'], compresslevel=9, mtime=0)
+                if len(packed) < st.st_size: asset['gzip'] = packed
+        else: asset['etag'] = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+        return asset
+
+    def get(self, name):
+        path = os.path.abspath(os.path.join(self.root, name))
+        rel = os.path.relpath(path, self.root)
+        if rel not in STATIC_FILES and os.path.dirname(rel) != 'components': return None # Not a dashboard file
+        with self.lock: asset = self.assets.get(path)
+        now = time.time()
+        if asset and now - asset['checked'] < STATIC_RECHECK_SECONDS: return asset
+        try: st = os.stat(path)
+        except OSError: st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            with self.lock: self.assets.pop(path, None)
+            return None
+        if asset and asset['mtime'] == st.st_mtime_ns and asset['size'] == st.st_size: asset['checked'] = now
+        else:
+            asset = self._load(path, st)
+            with self.lock: self.assets[path] = asset
+        return asset
+
+STATIC_ASSETS = StaticAssetCache()
+
 class HubRelayHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args): return
 
+    def handle_one_request(self):
+        if not METRICS_ENABLED: return super().handle_one_request()
+        t0 = time.perf_counter(); self.command = None
+        super().handle_one_request()
+        if self.command: # Bound label cardinality: method plus the first two path segments
+            record_timing('endpoint', f"{self.command} /" + '/'.join(urlparse(self.path).path.strip('/').split('/')[:2]), time.perf_counter() - t0)
+
     def send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
@@ -292,24 +1851,34 @@ class HubRelayHandler(BaseHTTPRequestHandler):
 
     def _serve_static_file(self, local_path):
         try:
-            # Ensure local_path is safe and within current directory or approved subdirectories
-            # This is a simple check, for production, more robust path sanitization might be needed.
-            if not os.path.normpath(local_path).startswith(os.getcwd()):
-                raise FileNotFoundError(f"Access to path outside working directory: {local_path}")
-
-            if not os.path.exists(local_path) or not os.path.isfile(local_path):
+            asset = STATIC_ASSETS.get(local_path)
+            if asset is None:
                 raise FileNotFoundError(f"File not found: {local_path}")
 
-            mime_type = get_mimetype(local_path)
+            if self.headers.get('If-None-Match') in (asset['etag'], '*'):
+                self.send_response(304)
+                self.send_cors_headers()
+                self.send_header('ETag', asset['etag'])
+                self.send_header('Cache-Control', STATIC_CACHE_CONTROL)
+                self.end_headers()
+                return
 
+            use_gzip = asset['gzip'] is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+            body = asset['gzip'] if use_gzip else asset['body']
             self.send_response(200)
             self.send_cors_headers()
-            self.send_header('Content-type', mime_type)
-            self.send_header('Content-Length', str(os.path.getsize(local_path)))
+            self.send_header('Content-type', asset['mime'])
+            self.send_header('Content-Length', str(len(body) if body is not None else asset['size']))
+            self.send_header('ETag', asset['etag'])
+            self.send_header('Cache-Control', STATIC_CACHE_CONTROL)
+            self.send_header('Vary', 'Accept-Encoding')
+            if use_gzip: self.send_header('Content-Encoding', 'gzip')
             self.end_headers()
 
-            with open(local_path, 'rb') as f:
-                self.wfile.write(f.read())
+            if body is not None: self.wfile.write(body)
+            else: # Too large to keep in memory: zero-copy from the file
+                self.wfile.flush()
+                with open(asset['path'], 'rb') as f: self.connection.sendfile(f, 0, asset['size'])
         except FileNotFoundError:
             self.send_response(404)
             self.send_cors_headers()
@@ -324,6 +1893,23 @@ class HubRelayHandler(BaseHTTPRequestHandler):
             self.wfile.write(f'500 Internal Server Error: {e}'.encode())
             log_audit(f"Error serving static file {local_path}: {e}")
 
+    def _serve_stream(self, name, producer):
+        self.send_response(200)
+        self.send_cors_headers()
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        sub = STREAMS.subscribe(name, producer)
+        try:
+            self.wfile.write(b"retry: 3000\n\n")
+            while True:
+                try: frame = sub.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty: frame = b": keepalive\n\n"
+                self.wfile.write(frame); self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, OSError): pass
+        finally: STREAMS.unsubscribe(name, sub)
+
     def do_GET(self):
         parsed_path = urlparse(self.path).path
 
@@ -333,15 +1919,131 @@ class HubRelayHandler(BaseHTTPRequestHandler):
 
         # --- API Endpoints (GET) ---
         if parsed_path == '/hub/agents':
+            detail = parse_qs(urlparse(self.path).query).get('detail', ['0'])[0] == '1'
+            with HUB_LOCK: # Lightweight summaries by default; ?detail=1 keeps the old full dump
+                body = json.dumps(HUB_AGENTS if detail else {aid: hub_agent_summary(aid, a) for aid, a in HUB_AGENTS.items()}).encode()
             self.send_response(200)
             self.send_cors_headers()
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            self.wfile.write(json.dumps(HUB_AGENTS).encode())
+            self.wfile.write(body)
+            return
+        elif parsed_path.startswith('/hub/agents/'):
+            aid = parsed_path[len('/hub/agents/'):]
+            with HUB_LOCK: body = json.dumps(dict({k: v for k, v in HUB_AGENTS[aid].items() if k not in HUB_INTERNAL_KEYS}, agentId=aid)).encode() if aid in HUB_AGENTS else None
+            if body is None:
+                self.send_response(404)
+                self.send_cors_headers()
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(b'404 Not Found')
+                return
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif parsed_path == '/hub/poll':
+            query = parse_qs(urlparse(self.path).query)
+            aid = query.get('agentId', [self.headers.get('X-Agent-ID')])[0]
+            try: wait = min(max(float(query.get('wait', [TASK_POLL_WAIT])[0]), 0), 60)
+            except ValueError: wait = TASK_POLL_WAIT
+            if not aid:
+                self.send_response(400)
+                self.send_cors_headers()
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(b'400 Bad Request: agentId missing.')
+                return
+            tasks = hub_wait_tasks(aid, wait)
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'tasks': tasks}).encode())
+            return
+        elif parsed_path == '/hub/history':
+            query = parse_qs(urlparse(self.path).query)
+            aid = query.get('agentId', [None])[0]; metric = query.get('metric', [None])[0]
+            try:
+                end = float(query.get('end', [time.time()])[0]); start = float(query.get('start', [end - 86400])[0])
+                step = max(float(query.get('step', [300])[0]), 1)
+            except ValueError:
+                start = end = step = None
+            if not aid or start is None or (end - start) / step > 100000:
+                self.send_response(400)
+                self.send_cors_headers()
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(b'400 Bad Request: agentId, numeric start/end/step required.')
+                return
+            result = {'agentId': aid, 'metrics': HUB_TSDB.metrics(aid)} if not metric else dict(HUB_TSDB.query(aid, metric, start, end, step), agentId=aid, metric=metric, step=step)
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(result).encode())
+            return
+        elif parsed_path == '/hub/jobs' or parsed_path.startswith('/hub/jobs/'):
+            query = parse_qs(urlparse(self.path).query)
+            jid = parsed_path[len('/hub/jobs/'):] if parsed_path.startswith('/hub/jobs/') else None
+            try: offset = max(int(query.get('offset', [0])[0]), 0); limit = min(max(int(query.get('limit', [100])[0]), 1), 1000)
+            except ValueError: offset, limit = 0, 100
+            with HUB_LOCK:
+                hub_evict_jobs()
+                if not jid: body = {'jobs': [hub_job_summary(j) for j in HUB_JOBS.values()]}
+                elif jid in HUB_JOBS:
+                    job = HUB_JOBS[jid]; aids = sorted(job['agents'])
+                    status = query.get('status', [None])[0]
+                    if status: aids = [a for a in aids if job['agents'][a]['status'] == status]
+                    page = aids[offset:offset + limit]
+                    body = dict(hub_job_summary(job), results=[dict(job['agents'][a], agentId=a) for a in page],
+                                next=offset + limit if offset + limit < len(aids) else None)
+                else: body = None
+                body = json.dumps(body).encode() if body is not None else None
+            if body is None:
+                self.send_response(404)
+                self.send_cors_headers()
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(b'404 Not Found')
+                return
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif parsed_path == '/metrics' and METRICS_ENABLED:
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif parsed_path == '/stream/stats':
+            self._serve_stream('stats', get_stats)
+            return
+        elif parsed_path.startswith('/stream/hub/agents/'):
+            aid = parsed_path[len('/stream/hub/agents/'):]
+            with HUB_LOCK: known = aid in HUB_AGENTS
+            if not known:
+                self.send_response(404)
+                self.send_cors_headers()
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(b'404 Not Found')
+                return
+            self._serve_stream(f"agent:{aid}", hub_agent_stream(aid))
             return
         elif parsed_path == '/hub/clear-result':
             aid = parse_qs(urlparse(self.path).query).get('agentId', [None])[0]
-            if aid in HUB_AGENTS: HUB_AGENTS[aid]['last_result'] = None
+            with HUB_LOCK:
+                if aid in HUB_AGENTS:
+                    HUB_AGENTS[aid]['last_result'] = None
+                    HUB_STATE.log({'op': 'result', 'aid': aid, 'result': None})
             self.send_response(200) # Send 200 for successful clear
             self.send_cors_headers()
             self.end_headers()
@@ -361,25 +2063,34 @@ class HubRelayHandler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps(load_config()).encode())
             return
         elif parsed_path == '/logs':
+            query = parse_qs(urlparse(self.path).query)
+            q = lambda k, d=None: query.get(k, [d])[0]
+            def when(v):
+                if not v: return None
+                try: return float(v)
+                except ValueError: return datetime.datetime.fromisoformat(v).timestamp()
             try:
-                with open(LOG_PATH, 'rb') as f:
-                    self.send_response(200)
-                    self.send_cors_headers()
-                    self.send_header('Content-type', 'text/plain')
-                    self.end_headers()
-                    self.wfile.write(f.read())
-            except FileNotFoundError:
-                self.send_response(404)
-                self.send_cors_headers()
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(b"No logs found.")
+                limit = min(max(int(q('limit', 200)), 1), 5000)
+                if q('after') is not None: result = AUDIT_LOG.tail_from(int(q('after')), limit)
+                else: result = AUDIT_LOG.query(q('type'), when(q('since')), when(q('until')), q('pid'), q('path'), q('q'), limit, q('cursor'))
             except Exception as e:
-                self.send_response(500)
+                self.send_response(400 if isinstance(e, ValueError) else 500)
                 self.send_cors_headers()
                 self.send_header('Content-type', 'text/plain')
                 self.end_headers()
-                self.wfile.write(f'500 Internal Server Error: {e}'.encode())
+                self.wfile.write(f'Log query failed: {e}'.encode())
+                return
+            if q('format', 'text') == 'json':
+                body = json.dumps(result).encode(); ctype = 'application/json'
+            else: # Plain text, oldest first, as the old full-file view
+                entries = result['entries'] if q('after') is not None else result['entries'][::-1]
+                body = ''.join(f"[{e.get('ts')}] {e.get('msg')}" + (f" (x{e['repeat']})" if e.get('repeat') else '') + '\n' for e in entries).encode() or b"No logs found."
+                ctype = 'text/plain'
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-type', ctype)
+            self.end_headers()
+            self.wfile.write(body)
             return
 
         # --- Static File Serving ---
@@ -399,19 +2110,42 @@ class HubRelayHandler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         content_length = int(self.headers.get('Content-Length', 0))
-        data = json.loads(self.rfile.read(content_length).decode())
+        body = self.rfile.read(content_length); encoding = self.headers.get('Content-Encoding', 'identity')
+        try: # Only agents compress, and only heartbeats
+            if self.path != '/hub/heartbeat' and encoding not in ('identity', ''): raise ValueError(f"unsupported Content-Encoding: {encoding}")
+            body = decompress_body(body, encoding)
+        except (ValueError, OverflowError) as e:
+            self.send_response(413 if isinstance(e, OverflowError) else 415)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(str(e).encode())
+            return
+        except Exception as e: # Corrupt compressed stream
+            self.send_response(400)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(f"bad body: {e}".encode())
+            return
+        data = json.loads(body.decode())
 
         # --- API Endpoints (POST) ---
         if self.path == '/hub/heartbeat':
             aid = self.headers.get('X-Agent-ID')
             if aid:
-                if aid not in HUB_AGENTS: HUB_AGENTS[aid] = {'tasks': [], 'stats': {}, 'last_result': None}
-                HUB_AGENTS[aid].update({'last_seen': time.time(), 'stats': data['stats'], 'config': data['current_config']})
+                with HUB_LOCK:
+                    reply = hub_apply_heartbeat(aid, data)
+                    reply['tasks'] = hub_deliver_tasks(aid)
+                    stats = HUB_AGENTS[aid]['stats']
+                if not reply.get('resync'):
+                    try: HUB_TSDB.record(aid, stats_metrics(stats))
+                    except Exception as e: log_audit(f"TSDB record error: {e}")
                 self.send_response(200)
                 self.send_cors_headers()
                 self.send_header('Content-type', 'application/json')
                 self.end_headers()
-                self.wfile.write(json.dumps({'tasks': HUB_AGENTS[aid].pop('tasks', [])}).encode())
+                self.wfile.write(json.dumps(reply).encode())
             else:
                 self.send_response(400) # Bad Request if no X-Agent-ID
                 self.send_cors_headers()
@@ -420,23 +2154,43 @@ class HubRelayHandler(BaseHTTPRequestHandler):
                 self.wfile.write(b'400 Bad Request: X-Agent-ID header missing.')
             return
         elif self.path == '/hub/task':
-            aid = data.get('agentId')
-            if aid in HUB_AGENTS: HUB_AGENTS[aid].setdefault('tasks', []).append(data)
+            aid = data.get('agentId'); task_id = None; status = 'unknown_agent'
+            with HUB_LOCK:
+                if aid in HUB_AGENTS:
+                    task_id = hub_queue_task(aid, data); status = 'queued' if task_id else 'queue_full'
             self.send_response(200)
             self.send_cors_headers()
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            self.wfile.write(b'{"status":"queued"}')
+            self.wfile.write(json.dumps({'status': status, 'taskId': task_id}).encode())
             return
         elif self.path == '/hub/result':
             aid = data.get('agentId')
-            if aid in HUB_AGENTS: HUB_AGENTS[aid]['last_result'] = data.get('result')
+            with HUB_LOCK:
+                if aid in HUB_AGENTS: hub_store_result(aid, data.get('taskId'), data.get('result'), data.get('final', True))
             self.send_response(200)
             self.send_cors_headers()
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             self.wfile.write(b'{"status":"ok"}')
             return
+        elif self.path == '/hub/job':
+            with HUB_LOCK:
+                job = hub_create_job(data) if data.get('type') else None
+                body = json.dumps(hub_job_summary(job)).encode() if job else None
+            if not body:
+                self.send_response(400 if not data.get('type') else 503)
+                self.send_cors_headers()
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(b'Job rejected: type missing or job store full.')
+                return
+            self.send_response(200)
+            self.send_cors_headers()
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+            return
         elif self.path == '/config': # Frontend POST to save config
             if save_config(data):
                 self.send_response(200)
@@ -458,10 +2212,204 @@ class HubRelayHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(b'404 Not Found')
 
+class HubServer(ThreadingHTTPServer):
+    # One thread per request so a slow /stats or agent upload never stalls other heartbeats
+    daemon_threads = True
+    request_queue_size = 1024
+
+def bench_hub(n_agents=200, duration=30, interval=2.0, hub=None):
+    """Simulate n_agents heartbeating every interval seconds and report latency percentiles."""
+    server = None; patches = _Patches(); tsdb_root = None
+    if not hub:
+        tsdb_root = tempfile.mkdtemp(prefix='ang-bench-tsdb-') # Keep bench series out of the real history
+        patches.set(sys.modules[__name__], 'HUB_TSDB', TimeSeriesStore(tsdb_root))
+        server = HubServer(('127.0.0.1', 0), HubRelayHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        hub = f"http://127.0.0.1:{server.server_address[1]}"
+    payload = json.dumps({'current_config': {}, 'stats': {'memoryTotal': 256.0, 'memoryFree': 12.5, 'swapUsagePct': 1.0, 'diskStats': [], 'topProcesses': []}}).encode()
+    latencies = []; errors = [0]; lat_lock = threading.Lock(); stop_at = time.time() + duration
+
+    def simulated_agent(idx):
+        aid = f"bench-{idx:05d}"
+        time.sleep(interval * idx / n_agents) # Spread agents across the interval
+        while time.time() < stop_at:
+            t0 = time.perf_counter()
+            try:
+                req = urllib.request.Request(f"{hub}/hub/heartbeat", data=payload, headers={'Content-Type': 'application/json', 'X-Agent-ID': aid})
+                with urllib.request.urlopen(req, timeout=10) as resp: resp.read()
+                with lat_lock: latencies.append(time.perf_counter() - t0)
+            except Exception:
+                with lat_lock: errors[0] += 1
+            time.sleep(max(0, interval - (time.perf_counter() - t0)))
+
+    workers = [threading.Thread(target=simulated_agent, args=(i,), daemon=True) for i in range(n_agents)]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    if server: server.shutdown(); server.server_close()
+    patches.restore()
+    if tsdb_root: shutil.rmtree(tsdb_root, ignore_errors=True)
+    latencies.sort()
+    pct = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 2) if latencies else None
+    report = {'agents': n_agents, 'duration_s': duration, 'requests': len(latencies), 'errors': errors[0], 'p50_ms': pct(0.50), 'p99_ms': pct(0.99), 'max_ms': pct(1.0)}
+    print(json.dumps(report, indent=2))
+    return report
+
+def bench_heartbeat(hours=1.0):
+    """Compare heartbeat bytes on the wire per agent per hour: legacy 2 s full JSON vs protocol v2."""
+    base = get_stats(); cfg = base['config']
+    def sample(tick, cadence):
+        t = tick * cadence; stats = dict(base)
+        stats['memoryFree'] = round(base['memoryFree'] + (tick % 7) * 0.01, 2)
+        stats['swapUsagePct'] = round(base['swapUsagePct'] + (tick % 3) * 0.1, 1)
+        if int(t // 300) % 2: stats['topProcesses'] = base['topProcesses'][::-1] # Process collector refresh
+        stats['lastUpdate'] = (datetime.datetime.now() + datetime.timedelta(seconds=t)).isoformat()
+        return stats
+    report = {'hours': hours, 'encodings': supported_encodings()}
+    legacy = sum(len(json.dumps({'current_config': cfg, 'stats': sample(i, 2)}).encode()) for i in range(int(hours * 3600 / 2)))
+    report['legacy_2s_bytes'] = legacy
+    for label, cadence in (('v2_2s_bytes', 2), (f'v2_{HEARTBEAT_INTERVAL}s_bytes', HEARTBEAT_INTERVAL)):
+        aid = f"bench-{uuid.uuid4().hex[:6]}"; enc = HeartbeatEncoder(); total = 0
+        for i in range(int(hours * 3600 / cadence)):
+            body, headers = enc.encode(cfg, sample(i, cadence)); total += len(body)
+            data = json.loads(decompress_body(body, headers.get('Content-Encoding', 'identity')).decode())
+            with HUB_LOCK: enc.on_response(hub_apply_heartbeat(aid, data))
+        with HUB_LOCK: HUB_AGENTS.pop(aid, None)
+        report[label] = total
+    report['v2_2s_ratio'] = round(report['v2_2s_bytes'] / legacy, 4)
+    print(json.dumps(report, indent=2))
+    return report
+
+# --- Benchmark suite ---
+# 'agent.py --bench' times collectors, tuning scans, tasks and hub endpoints. By default psutil,
+# subprocess, /proc and the tunables tree are replaced with fakes so it runs anywhere;
+# --real measures the host itself. Results are JSON for regression comparison.
+BENCH_FAKE_PROCS = 2000
+BENCH_FAKE_OUTPUT = {
+    'hostnamectl': b"   Static hostname: bench\n  Operating System: SUSE Linux Enterprise Server 15 SP5\n            Kernel: Linux 5.14.21\n",
+    'lscpu': b"Architecture: x86_64\nModel name: Bench CPU @ 2.10GHz\n",
+    'hostname': b"10.0.0.10 \n",
+}
+
+class _Patches:
+    def __init__(self): self.saved = []
+    def set(self, obj, attr, value): self.saved.append((obj, attr, getattr(obj, attr))); setattr(obj, attr, value)
+    def restore(self):
+        for obj, attr, value in reversed(self.saved): setattr(obj, attr, value)
+
+def _bench_fake_tree(root):
+    for pid in range(1, BENCH_FAKE_PROCS + 1):
+        os.makedirs(f"{root}/proc/{pid}")
+        rss_pages = (pid * 7919) % 4_000_000 # Spread up to ~16 GB
+        with open(f"{root}/proc/{pid}/stat", 'w') as f:
+            f.write(f"{pid} (proc-{pid}) S 1 {pid} {pid} 0 -1 4194560 0 0 0 0 {pid * 3} {pid} 0 0 20 0 1 0 {pid * 11} 0 {rss_pages} 0\n")
+    for e in TUNING_CATALOG:
+        p = tunable_path(e, root); os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(p, 'w') as f: f.write('always madvise [never]\n' if 'transparent' in p else '65530\n')
+    os.makedirs(f"{root}/dir")
+    for i in range(5000): open(f"{root}/dir/trace_{i:05d}.trc", 'w').close()
+
+def _bench_fakes(root, forks):
+    p = _Patches()
+    Mem = collections.namedtuple('Mem', 'total available percent used free')
+    Swap = collections.namedtuple('Swap', 'total used free percent sin sout')
+    Disk = collections.namedtuple('Disk', 'total used free percent')
+    def fake_check_output(cmd, *a, **kw):
+        forks[0] += 1; return BENCH_FAKE_OUTPUT.get(os.path.basename(cmd[0] if isinstance(cmd, list) else cmd.split()[0]), b"")
+    class FakePopen:
+        def __init__(self, *a, **kw): forks[0] += 1
+        def read(self): return ""
+        def close(self): return None
+    p.set(psutil, 'virtual_memory', lambda: Mem(512 * 1024**3, 100 * 1024**3, 80.0, 400 * 1024**3, 12 * 1024**3))
+    p.set(psutil, 'swap_memory', lambda: Swap(8 * 1024**3, 1024**3, 7 * 1024**3, 12.5, 0, 0))
+    p.set(psutil, 'disk_usage', lambda path: Disk(1024**4, 800 * 1024**3, 224 * 1024**3, 78.1))
+    p.set(subprocess, 'check_output', fake_check_output)
+    p.set(os, 'popen', lambda *a, **kw: FakePopen())
+    p.set(PROCESS_SAMPLER, 'root', f"{root}/proc")
+    p.set(sys.modules[__name__], 'TUNABLE_ROOT', root)
+    return p
+
+def _bench_measure(fn, iterations, forks):
+    times = []; f0 = forks[0]
+    for _ in range(iterations):
+        t0 = time.perf_counter(); fn(); times.append(time.perf_counter() - t0)
+    forked = forks[0] - f0 # Before the extra allocation-tracing call below
+    tracemalloc.start(); fn(); _, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    pct = percentiles(times)
+    return {'iterations': iterations, 'p50_ms': round(pct[0.5] * 1000, 4), 'p90_ms': round(pct[0.9] * 1000, 4), 'p99_ms': round(pct[0.99] * 1000, 4),
+            'max_ms': round(max(times) * 1000, 4), 'forks_per_call': round(forked / iterations, 2), 'peak_alloc_kb': round(peak / 1024, 1)}
+
+def bench_suite(iterations=200, real=False, out=None):
+    forks = [0]; root = tempfile.mkdtemp(prefix='ang-bench-'); patches = None
+    if real: # Count forks on the host too
+        real_popen = subprocess.Popen
+        class CountingPopen(real_popen):
+            def __init__(self, *a, **kw): forks[0] += 1; super().__init__(*a, **kw)
+        patches = _Patches(); patches.set(subprocess, 'Popen', CountingPopen)
+    else:
+        _bench_fake_tree(root); patches = _bench_fakes(root, forks)
+    patches.set(sys.modules[__name__], 'STATIC_ASSETS', StaticAssetCache(os.path.dirname(os.path.abspath(__file__))))
+    patches.set(sys.modules[__name__], 'HUB_TSDB', TimeSeriesStore(os.path.join(root, 'tsdb'))) # Keep bench series out of the real history
+    report = {'mode': 'real' if real else 'fake', 'python': sys.version.split()[0], 'when': datetime.datetime.now().isoformat(), 'collectors': {}, 'agent': {}, 'endpoints': {}}
+    try:
+        cfg = load_config()
+        for name, c in COLLECTORS.items(): # Uncached cost of each family
+            report['collectors'][name] = _bench_measure(lambda c=c: c['fn'](cfg), iterations if name != 'serverInfo' else max(iterations // 10, 5), forks)
+        get_stats() # Warm the collector cache so the timed calls measure the cached path
+        report['agent']['get_stats_cached'] = _bench_measure(get_stats, iterations, forks)
+        report['agent']['get_detailed_server_info'] = _bench_measure(get_detailed_server_info, max(iterations // 10, 5), forks)
+        report['agent']['scan_tune'] = _bench_measure(lambda: scan_tune(None if real else root), iterations, forks)
+        report['agent']['ls_page'] = _bench_measure(lambda: list_dir({'path': f"{root}/dir" if not real else '/usr/lib', 'limit': 500, 'sort': 'size'}), max(iterations // 10, 5), forks)
+        enc = HeartbeatEncoder(); stats = get_stats()
+        report['agent']['heartbeat_bytes'] = {'legacy': len(json.dumps({'current_config': cfg, 'stats': stats}).encode())}
+        enc.protocol = HEARTBEAT_PROTOCOL; enc.encoding = 'gzip'
+        report['agent']['heartbeat_bytes']['v2_full_gzip'] = len(enc.encode(cfg, stats)[0])
+
+        server = HubServer(('127.0.0.1', 0), HubRelayHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        hub = f"http://127.0.0.1:{server.server_address[1]}"
+        hb = json.dumps({'current_config': cfg, 'stats': stats}).encode()
+        def call(path, data=None, headers={}):
+            req = urllib.request.Request(hub + path, data=data, headers=headers)
+            with urllib.request.urlopen(req, timeout=10) as resp: return len(resp.read())
+        for i in range(50): call('/hub/heartbeat', hb, {'X-Agent-ID': f"bench-{i}"})
+        endpoints = {
+            'POST /hub/heartbeat': lambda: call('/hub/heartbeat', hb, {'X-Agent-ID': 'bench-0'}),
+            'GET /hub/agents': lambda: call('/hub/agents'),
+            'GET /hub/agents?detail=1': lambda: call('/hub/agents?detail=1'),
+            'GET /hub/poll (idle)': lambda: call('/hub/poll?agentId=bench-0&wait=0'),
+            'GET /stats': lambda: call('/stats'),
+            'GET /App.tsx': lambda: call('/App.tsx', headers={'Accept-Encoding': 'gzip'}),
+        }
+        for name, fn in endpoints.items():
+            report['endpoints'][name] = dict(_bench_measure(fn, iterations, forks), response_bytes=fn())
+        server.shutdown()
+        with HUB_LOCK:
+            for aid in [a for a in HUB_AGENTS if a.startswith('bench-')]: HUB_AGENTS.pop(aid)
+    finally:
+        patches.restore(); shutil.rmtree(root, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, 'w') as f: f.write(text)
+    print(text)
+    return report
+
+def _arg_value(flag, default):
+    if flag in sys.argv:
+        try: return type(default)(sys.argv[sys.argv.index(flag) + 1])
+        except (IndexError, ValueError): pass
+    return default
+
 
 if __name__ == "__main__":
     if "--agent" in sys.argv: agent_push_loop()
+    elif "--bench-hub" in sys.argv:
+        bench_hub(_arg_value('--agents', 200), _arg_value('--duration', 30), hub=_arg_value('--hub', ''))
+    elif "--bench-heartbeat" in sys.argv: bench_heartbeat(_arg_value('--hours', 1.0))
+    elif "--bench" in sys.argv: bench_suite(_arg_value('--iterations', 200), real="--real" in sys.argv, out=_arg_value('--out', ''))
     else:
+        HUB_STATE.recover()
+        threading.Thread(target=hub_maintenance_loop, daemon=True).start()
         threading.Thread(target=agent_push_loop, daemon=True).start()
         print("ANG Hub starting on 0.0.0.0:9090...")
-        HTTPServer(('0.0.0.0', 9090), HubRelayHandler).serve_forever()
+        STATIC_ASSETS.preload()
+        HubServer(('0.0.0.0', 9090), HubRelayHandler).serve_forever()
@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import agent
+
+
+class ApplyTuneTest(unittest.TestCase):
+    """apply/revert against a fake TUNABLE_ROOT; nothing touches the real /proc or /etc."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(); self.root = self.tmp.name
+        self.entries = agent.tuning_catalog()[1]
+        for e in self.entries:
+            path = agent.tunable_path(e, self.root)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f: f.write('12345\n')
+        self.patches = [mock.patch.object(agent, 'TUNABLE_ROOT', self.root),
+                        mock.patch.object(agent, 'REVERT_PATH', os.path.join(self.root, 'etc', 'revert_state.json'))]
+        for p in self.patches: p.start()
+        os.makedirs(os.path.dirname(agent.REVERT_PATH))
+
+    def tearDown(self):
+        for p in self.patches: p.stop()
+        self.tmp.cleanup()
+
+    def current(self):
+        return agent.read_tunables(self.entries)
+
+    def test_snapshot_write_failure_applies_nothing(self):
+        agent.REVERT_PATH = os.path.join(self.root, 'missing', 'revert_state.json')
+        before = self.current()
+        with self.assertRaises(OSError): agent.apply_tune()
+        self.assertEqual(self.current(), before)
+        self.assertFalse(os.path.exists(agent.REVERT_PATH))
+
+    def test_write_failure_restores_previous_snapshot(self):
+        with open(agent.REVERT_PATH, 'w') as f: json.dump({'version': '1+0', 'values': {'kernel.pid_max': '4242'}}, f)
+        with mock.patch.object(agent, 'write_tunables', side_effect=OSError('read-only')):
+            with self.assertRaises(OSError): agent.apply_tune()
+        with open(agent.REVERT_PATH) as f: self.assertEqual(json.load(f)['values'], {'kernel.pid_max': '4242'})
+
+    def test_write_failure_without_snapshot_leaves_none(self):
+        with mock.patch.object(agent, 'write_tunables', side_effect=OSError('read-only')):
+            with self.assertRaises(OSError): agent.apply_tune()
+        self.assertFalse(os.path.exists(agent.REVERT_PATH))
+
+    def test_apply_then_revert_round_trip(self):
+        before = self.current()
+        self.assertTrue(agent.apply_tune())
+        self.assertNotEqual(self.current(), before)
+        agent.revert_tune()
+        self.assertEqual(self.current(), before)
+        self.assertFalse(os.path.exists(agent.REVERT_PATH))
+
+
+if __name__ == '__main__':
+    unittest.main()
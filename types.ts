@@ -34,6 +34,8 @@ export interface ProcessInfo {
   name: string;
   memGB: number;
   user: string;
+  cpuPct?: number;       // average over the last sampling interval
+  rssGrowthMBs?: number; // RSS growth rate, MB per second
 }
 
 export interface ServerStats {
@@ -48,6 +50,7 @@ export interface ServerStats {
     usage_pct: number;
   }[];
   topProcesses: ProcessInfo[];
+  fastestGrowing?: ProcessInfo[];
   lastUpdate: string;
   oomDetected: boolean;
   swapUsagePct: number;